@@ -0,0 +1,277 @@
+# Benchmarks for navigator_core on synthetic products.
+#
+# Runs in plain CPython, no FreeCAD or Qt needed:
+#
+#   python benchmark.py                  # 1k/10k/50k refdes
+#   python benchmark.py --sizes 1000 --repeat 5 --json bench.json
+#   python benchmark.py --products 500   # startup with 500 product folders
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import navigator_core as core
+
+# smallest valid PNG, picture content does not matter for these timings
+PNG_1X1 = bytes.fromhex(
+  '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+  '1f15c4890000000d49444154789c6300010000000500010d0a2db40000'
+  '000049454e44ae426082')
+
+
+def make_product(root, n_refdes, n_pages, n_pictures, n_tests=5, notes_ratio=0.1):
+  # components.txt with n_refdes spread over n_pages, every 10th a testpoint,
+  # note folders for notes_ratio of them and n_pictures spread over those
+  product_path = os.path.join(root, 'product_%d'%n_refdes)
+  os.makedirs(os.path.join(product_path, 'components'))
+  os.makedirs(os.path.join(product_path, 'testpoints'))
+  os.makedirs(os.path.join(product_path, 'teststeps'))
+
+  refdes_list = []
+  with open(os.path.join(product_path, 'components.txt'), 'w') as f:
+    for page in range(n_pages):
+      f.write('[page%d]\n'%page)
+      for i in range(page, n_refdes, n_pages):
+        refdes = 'TP%d'%i if i % 10 == 0 else 'R%d'%i
+        refdes_list.append(refdes)
+        f.write(refdes + '\n')
+
+  annotated = refdes_list[::max(1, int(1 / notes_ratio))]
+  for refdes in annotated:
+    group = 'testpoints' if refdes.startswith('TP') else 'components'
+    folder = os.path.join(product_path, group, refdes)
+    os.makedirs(folder)
+    with open(os.path.join(folder, 'readme.txt'), 'w') as f:
+      f.write('reworked %s\n'%refdes)
+
+  for i in range(n_pictures):
+    refdes = annotated[i % len(annotated)]
+    group = 'testpoints' if refdes.startswith('TP') else 'components'
+    stem = os.path.join(product_path, group, refdes, 'picture_%d'%i)
+    with open(stem + '.png', 'wb') as f:
+      f.write(PNG_1X1)
+    with open(stem + '.txt', 'w') as f:
+      f.write('picture %d\n'%i)
+
+  for test in range(n_tests):
+    core.make_test_folder(os.path.join(product_path, 'teststeps'), 'Test %d'%test,
+                          ['page%d'%page for page in range(n_pages)], 'all')
+
+  return product_path, refdes_list
+
+
+class Vector:
+  def __init__(self, x, y, z):
+    self.x, self.y, self.z = x, y, z
+
+
+class FakeBoundBox:
+  def __init__(self, x, y, size=0.8):
+    self.Center = Vector(x, y, 0)
+    self.XMin, self.YMin = x - size / 2, y - size / 2
+    self.XMax, self.YMax = x + size / 2, y + size / 2
+    self.ZMin, self.ZMax = 0, size / 2
+
+
+class FakeShape:
+  def __init__(self, x, y):
+    self.BoundBox = FakeBoundBox(x, y)
+
+
+class FakeObject:
+  # stands in for the FreeCAD objects ModelIndex walks
+  def __init__(self, name, label=None, children=(), x=0, y=0):
+    self.Name = name
+    self.Label = label or name
+    self.Shape = FakeShape(x, y)
+    self._children = {child.Name: child for child in children}
+
+  def getSubObjects(self):
+    return ['%s.'%name for name in self._children]
+
+  def getObject(self, name):
+    return self._children.get(name)
+
+
+class FakeDocument:
+  def __init__(self, refdes_list, file_name=''):
+    self.FileName = file_name
+    layers = {'Top': [], 'Bottom': []}
+    for i, refdes in enumerate(refdes_list):
+      layers['Top' if i % 2 else 'Bottom'].append(FakeObject(refdes, x=i % 100, y=i // 100))
+
+    top = FakeObject('ComponentsTop', children=layers['Top'])
+    bottom = FakeObject('ComponentsBottom', children=layers['Bottom'])
+    self.Name = 'bench'
+    self._objects = {
+      'Components': FakeObject('Components', children=[top, bottom]),
+      'PlaceBound': None,
+    }
+    self.Objects = [top, bottom] + layers['Top'] + layers['Bottom']
+    for obj in self.Objects:
+      self._objects.setdefault(obj.Name, obj)
+
+  def getObject(self, name):
+    return self._objects.get(name)
+
+
+def timed(results, name, func, repeat):
+  # best of `repeat` runs, in milliseconds
+  best = None
+  result = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = func()
+    elapsed = (time.perf_counter() - start) * 1000
+    best = elapsed if best is None else min(best, elapsed)
+  results[name] = best
+  return result
+
+
+def run(n_refdes, root, repeat):
+  n_pages = max(10, n_refdes // 100)
+  n_pictures = max(100, n_refdes // 10)
+  results = {}
+
+  start = time.perf_counter()
+  product_path, refdes_list = make_product(root, n_refdes, n_pages, n_pictures)
+  results['generate'] = (time.perf_counter() - start) * 1000
+
+  never = lambda: False
+
+  prodfile = os.path.join(product_path, 'components.txt')
+  def components_parse():
+    return core.ProductModel.parse(prodfile)
+  timed(results, 'components.txt parse', components_parse, repeat)
+
+  def product_load():
+    return core.read_product(product_path, core.NotesIndex(), never)
+  product = timed(results, 'product load (cached model)', product_load, repeat)
+
+  test_folder = os.path.join(product['teststeps_path'], product['test_steps'][0])
+  test = timed(results, 'test load', lambda: core.read_test(test_folder, product['model'], never), repeat)
+
+  notes = core.NotesIndex()
+  def tree_build():
+    rows = 0
+    for group, data in (('Components', test['components']), ('Testpoints', test['testpoints'])):
+      page_notes = notes.notes(product['path'][group])
+      for page, refdes_list in data.items():
+        rows += len(core.page_rows(refdes_list, page_notes))
+    return rows
+  timed(results, 'tree build', tree_build, repeat)
+
+  index = core.RefdesIndex()
+  timed(results, 'search index build', lambda: index.build({'Components': product['model'].components, 'Testpoints': product['model'].testpoints}), repeat)
+  timed(results, 'search "R1"', lambda: index.search('R1'), repeat)
+
+  model_file = os.path.join(product_path, core.MODEL_FILE)
+  cache_file = os.path.join(product_path, core.MODEL_CACHE_FILE)
+  os.makedirs(os.path.dirname(model_file))
+  open(model_file, 'w').close()
+
+  doc = FakeDocument(refdes_list, model_file)
+  model = core.ModelIndex()
+  model.preload(model_file, cache_file, None)
+  timed(results, 'model index build + sidecar', lambda: model.build(doc), repeat)
+  lookups = refdes_list[::max(1, len(refdes_list) // 1000)]
+  def selection_lookup():
+    for refdes in lookups:
+      model.get(doc, refdes)
+  timed(results, 'selection lookup x%d'%len(lookups), selection_lookup, repeat)
+
+  records = timed(results, 'model sidecar load', lambda: core.load_model_cache(cache_file, model_file), repeat)
+  def preloaded_lookup():
+    preloaded = core.ModelIndex()
+    preloaded.preload(model_file, cache_file, records)
+    for refdes in lookups:
+      preloaded.get(doc, refdes)
+  timed(results, 'preloaded lookup x%d'%len(lookups), preloaded_lookup, repeat)
+
+  board = timed(results, 'spatial index build', lambda: core.board_index(records), repeat)
+  def point_queries():
+    for i in range(1000):
+      board['Top'].nearest(i % 100 + 0.3, (i * 7) % (n_refdes // 100 + 1))
+  timed(results, 'nearest part x1000', point_queries, repeat)
+  timed(results, 'rectangle query', lambda: board['Top'].query_rect(10, 10, 40, 40), repeat)
+
+  note_folder = os.path.join(product['path']['Components'], sorted(notes.notes(product['path']['Components']))[0])
+  note_file = os.path.join(note_folder, 'readme.txt')
+  saves = iter(range(10**9))
+  timed(results, 'save', lambda: core.save_with_backup(note_file, 'bench text %d\n'%next(saves)), repeat)
+  timed(results, 'save unchanged', lambda: core.save_with_backup(note_file, 'bench text\n'), repeat)
+
+  return results
+
+
+def run_startup(root, n_products, repeat):
+  # what the panel does before it can show products: import the core
+  # in a fresh interpreter and list a products folder
+  results = {}
+  here = os.path.dirname(os.path.abspath(__file__))
+  code = 'import sys, time; sys.path.insert(0, %r); start = time.perf_counter(); import navigator_core; print(time.perf_counter() - start)'%here
+  best = None
+  for _ in range(repeat):
+    elapsed = float(subprocess.check_output([sys.executable, '-c', code])) * 1000
+    best = elapsed if best is None else min(best, elapsed)
+  results['import navigator_core'] = best
+
+  products_path = os.path.join(root, 'products')
+  for i in range(n_products):
+    os.makedirs(os.path.join(products_path, 'product_%d'%i))
+    with open(os.path.join(products_path, 'product_%d'%i, 'components.txt'), 'w') as f:
+      f.write('[page0]\nR1\n')
+  catalogue_file = os.path.join(root, core.CATALOGUE_FILE)
+  def catalogue_cold():
+    if os.path.exists(catalogue_file):
+      os.remove(catalogue_file)
+    return core.ProductCatalogue(catalogue_file).refresh(products_path, lambda: False)
+  timed(results, 'catalogue refresh, %d new'%n_products, catalogue_cold, repeat)
+  catalogue = core.ProductCatalogue(catalogue_file)
+  timed(results, 'catalogue refresh (unchanged)', lambda: catalogue.refresh(products_path, lambda: False), repeat)
+  timed(results, 'catalogue products', lambda: catalogue.products(products_path), repeat)
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Time navigator_core on synthetic products')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='refdes per synthetic product')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is reported')
+  parser.add_argument('--products', type=int, default=200, help='product folders for the startup measurement')
+  parser.add_argument('--json', help='also write the results to this file')
+  parser.add_argument('--keep', action='store_true', help='keep the generated products')
+  args = parser.parse_args(argv)
+
+  root = tempfile.mkdtemp(prefix='navigator_bench_')
+  all_results = {}
+  try:
+    results = run_startup(root, args.products, args.repeat)
+    all_results['startup'] = results
+    print('startup')
+    for name, ms in results.items():
+      print('  %-28s %10.2f ms'%(name, ms))
+
+    for n_refdes in args.sizes:
+      results = run(n_refdes, root, args.repeat)
+      all_results[n_refdes] = results
+      print('%d refdes'%n_refdes)
+      for name, ms in results.items():
+        print('  %-28s %10.2f ms'%(name, ms))
+  finally:
+    if args.keep:
+      print('products kept in %s'%root)
+    else:
+      shutil.rmtree(root, ignore_errors=True)
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(all_results, f, indent=2)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,23 +1,490 @@
+import FreeCAD
 import FreeCADGui as Gui
 
 from PySide2.QtCore import QThread
 from PySide2.QtCore import Signal, Slot
 
 from PySide2.QtWidgets import QTreeWidgetItem
+from PySide2.QtGui import QImage, QPixmap
 
-import socket
 import os
+import sys
 import PySide2
-import configparser
-import glob
-import subprocess
-import shutil
-from pathlib import Path
-from datetime import datetime
-from pivy import coin
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+from collections import OrderedDict, deque
+
+# FreeCAD runs macros without their folder on sys.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from navigator_core import (ModelIndex, NotesIndex, RefdesIndex, NotesSearchIndex,
+                            read_text, read_versioned, file_version, merge3,
+                            read_product, read_test, list_pictures,
+                            page_rows, make_test_folder, make_info_folder, save_with_backup,
+                            ProductModel, load_product_model, board_index, marker_position,
+                            PictureImport, display_copy_path, report_entries, write_report,
+                            ProductCatalogue, CATALOGUE_FILE, profile, timed,
+                            BACKUP_KEEP, BACKUP_MAX_AGE_DAYS, BACKUP_PACK_AFTER)
+
+log = logging.getLogger('pcb_navigator')
+
+# memory budget for scaled pictures kept by the picture cache
+PIXMAP_CACHE_BYTES = 64*1024*1024
+
+# default disk budget for the thumbnail store, see "thumbnail_cache_mb" setting
+THUMBNAIL_CACHE_MB = 256
+# icon height used by the thumbnail strip
+THUMBNAIL_STRIP_HEIGHT = 64
+
+# quiet time after the last keystroke before notes are saved
+AUTOSAVE_MS = 2000
+
+# picture import: copy threads and height of the optional display copies
+IMPORT_WORKERS = 4
+DISPLAY_COPY_HEIGHT = 1080
+
+# test step report: thumbnail threads and thumbnail height
+REPORT_WORKERS = 4
+REPORT_THUMBNAIL_HEIGHT = 240
+
+# pixels the mouse may move between press and release of a click in the 3D view
+CLICK_SLOP = 4
+
+# default of the "log_level" setting
+LOG_LEVEL = 'INFO'
+
+
+class ConsoleHandler(logging.Handler):
+  # log records to the FreeCAD report view, by level
+  def emit(self, record):
+    msg = self.format(record) + '\n'
+    if record.levelno >= logging.ERROR:
+      FreeCAD.Console.PrintError(msg)
+    elif record.levelno >= logging.WARNING:
+      FreeCAD.Console.PrintWarning(msg)
+    elif record.levelno >= logging.INFO:
+      FreeCAD.Console.PrintMessage(msg)
+    else:
+      FreeCAD.Console.PrintLog(msg)
+
+
+class ModelObserver:
+  # FreeCAD document observer keeping the ModelIndex in sync
+  def __init__(self, index):
+    self.index = index
+
+  def slotCreatedObject(self, obj):
+    # objects created while a file is opened are not a change to the model
+    self.index.invalidate(objects_changed=not getattr(obj.Document, 'Restoring', False))
+
+  def slotDeletedObject(self, obj):
+    self.index.invalidate(objects_changed=True)
+
+  def slotChangedObject(self, obj, prop):
+    if prop == 'Label':
+      self.index.invalidate_labels()
+
+  def slotActivateDocument(self, doc):
+    self.index.invalidate()
+
+  def slotDeletedDocument(self, doc):
+    self.index.invalidate()
+
+
+class NotesOverlay:
+  # markers for all annotated parts, drawn by one Coin node per layer with a
+  # single coordinate array, so toggling and updates never touch ViewProviders
+  LAYER_COLORS = {'Top': (1.0, 0.45, 0.0), 'Bottom': (0.0, 0.6, 1.0)}
+
+  def __init__(self):
+    # nodes are made on first use, pivy.coin is slow to import at startup
+    self.coin = None
+    self.root = None
+    self.view = None
+    self.layers = {} # layer -> (SoCoordinate3, SoPointSet, [refdes], {refdes: index})
+
+  def _build(self):
+    if self.root is not None:
+      return
+    from pivy import coin
+    self.coin = coin
+    self.root = coin.SoSwitch()
+    self.root.whichChild = coin.SO_SWITCH_NONE
+
+    group = coin.SoSeparator()
+    pick_style = coin.SoPickStyle()
+    pick_style.style = coin.SoPickStyle.UNPICKABLE
+    group.addChild(pick_style)
+    for layer, color in self.LAYER_COLORS.items():
+      separator = coin.SoSeparator()
+      material = coin.SoMaterial()
+      material.diffuseColor = color
+      material.emissiveColor = color
+      style = coin.SoDrawStyle()
+      style.pointSize = 9
+      coords = coin.SoCoordinate3()
+      points = coin.SoPointSet()
+      points.numPoints = 0
+      for node in (material, style, coords, points):
+        separator.addChild(node)
+      group.addChild(separator)
+      self.layers[layer] = (coords, points, [], {})
+    self.root.addChild(group)
+
+  def attach(self, view):
+    if self.view is view:
+      return
+    self._build()
+    self.detach()
+    view.getSceneGraph().addChild(self.root)
+    self.view = view
+
+  def detach(self):
+    if self.view is not None:
+      try:
+        self.view.getSceneGraph().removeChild(self.root)
+      except Exception:
+        pass # view already closed
+      self.view = None
+
+  def set_visible(self, visible):
+    if self.root is None and not visible:
+      return
+    self._build()
+    self.root.whichChild = self.coin.SO_SWITCH_ALL if visible else self.coin.SO_SWITCH_NONE
+
+  def set_markers(self, markers):
+    # markers: {refdes: (layer, (x, y, z))}, replaces everything in one go
+    self._build()
+    for layer, (coords, points, refdes_list, index) in self.layers.items():
+      refdes_list[:] = [refdes for refdes, marker in markers.items() if marker[0] == layer]
+      index.clear()
+      index.update((refdes, i) for i, refdes in enumerate(refdes_list))
+      coords.point.setNum(len(refdes_list))
+      if refdes_list:
+        coords.point.setValues(0, len(refdes_list), [markers[refdes][1] for refdes in refdes_list])
+      points.numPoints = len(refdes_list)
+
+  def set_marker(self, refdes, layer, position, state):
+    # add or remove one marker without rebuilding the arrays
+    self._build()
+    coords, points, refdes_list, index = self.layers[layer]
+    if state and refdes not in index:
+      index[refdes] = len(refdes_list)
+      refdes_list.append(refdes)
+      coords.point.set1Value(index[refdes], position)
+    elif not state and refdes in index:
+      # move the last marker into the freed slot
+      i = index.pop(refdes)
+      last = refdes_list.pop()
+      if last != refdes:
+        refdes_list[i] = last
+        index[last] = i
+        coords.point.set1Value(i, coords.point[len(refdes_list)])
+      coords.point.setNum(len(refdes_list))
+    else:
+      return
+    points.numPoints = len(refdes_list)
+
+
+class NotesIndexer(QThread):
+  # brings a product's NotesSearchIndex up to date in the background
+  indexed = Signal(str, int)
+
+  def __init__(self, index, parent=None):
+    super().__init__(parent)
+    self.index = index
+
+  def run(self):
+    import sqlite3
+    try:
+      updated = self.index.update(self.isInterruptionRequested)
+    except (OSError, sqlite3.Error) as e:
+      log.error('notes index failed: %s', e)
+      return
+    self.indexed.emit(self.index.product_path, updated)
+
+
+class PixmapCache:
+  # least recently used scaled pixmaps, bounded by a byte budget
+  def __init__(self, budget):
+    self.budget = budget
+    self.size = 0
+    self._items = OrderedDict() # key -> (pixmap, nbytes)
+
+  def get(self, key):
+    entry = self._items.get(key)
+    if entry is None:
+      return None
+    self._items.move_to_end(key)
+    return entry[0]
+
+  def put(self, key, pixmap):
+    nbytes = pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+    if key in self._items:
+      self.size -= self._items.pop(key)[1]
+    self._items[key] = (pixmap, nbytes)
+    self.size += nbytes
+
+    # always keep the newest entry, even if it alone exceeds the budget
+    while self.size > self.budget and len(self._items) > 1:
+      self.size -= self._items.popitem(last=False)[1][1]
+
+  def clear(self):
+    self._items.clear()
+    self.size = 0
+
+
+class ThumbnailStore:
+  # scaled copies of pictures on local disk, keyed by source path, mtime,
+  # size and height, so previews don't re-read originals from the share
+  def __init__(self, folder, budget):
+    self.folder = folder
+    self.budget = budget
+    self._lock = threading.Lock()
+    self._size = None
+    os.makedirs(self.folder, exist_ok=True)
+
+  def thumbnail_path(self, path, height):
+    import hashlib
+    stat = os.stat(path)
+    key = '%s|%d|%d|%d'%(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, height)
+    return os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jpg')
+
+  def load(self, path, height):
+    try:
+      thumb_path = self.thumbnail_path(path, height)
+    except OSError:
+      return QImage()
+
+    if os.path.isfile(thumb_path):
+      image = QImage(thumb_path)
+      if not image.isNull():
+        os.utime(thumb_path) # mark as recently used for pruning
+        return image
+
+    # the display copy made at import is much cheaper to read than the original
+    display_path = display_copy_path(path)
+    image = QImage(display_path) if os.path.isfile(display_path) else QImage()
+    if image.isNull() or image.height() < height:
+      image = QImage(path)
+    if image.isNull():
+      return image
+    image = image.scaledToHeight(height, PySide2.QtCore.Qt.SmoothTransformation)
+
+    tmp_path = '%s.%d.tmp'%(thumb_path, threading.get_ident())
+    if image.save(tmp_path, 'JPG', 85):
+      os.replace(tmp_path, thumb_path)
+      self._added(os.path.getsize(thumb_path))
+    return image
+
+  def _added(self, nbytes):
+    with self._lock:
+      if self._size is None:
+        self._size = sum(entry.stat().st_size for entry in os.scandir(self.folder) if entry.is_file())
+      else:
+        self._size += nbytes
+      if self._size > self.budget:
+        self._prune()
+
+  def _prune(self):
+    # drop least recently used thumbnails until well below the budget
+    entries = sorted((entry for entry in os.scandir(self.folder) if entry.is_file()),
+                     key=lambda entry: entry.stat().st_mtime)
+    for entry in entries:
+      if self._size <= self.budget * 0.9:
+        break
+      try:
+        size = entry.stat().st_size
+        os.remove(entry.path)
+        self._size -= size
+      except OSError:
+        pass
+
+
+class PictureLoader(QThread):
+  # decodes and scales pictures off the GUI thread. QPixmap may only be used
+  # on the GUI thread, so scaled QImages are handed back through `loaded`
+  loaded = Signal(str, int, object)
+
+  def __init__(self, store=None, parent=None):
+    super().__init__(parent)
+    self.store = store
+    self._jobs = deque()
+    self._pending = set()
+    self._prefetch = set() # pending jobs nobody waits for yet
+    self._cond = threading.Condition()
+    self._stopped = False
+
+  def request(self, path, height, urgent=True):
+    job = (path, height)
+    with self._cond:
+      if job in self._pending:
+        if urgent and job in self._prefetch:
+          # move ahead of prefetch jobs
+          self._prefetch.discard(job)
+          self._jobs.remove(job)
+          self._jobs.appendleft(job)
+        return
+      self._pending.add(job)
+      if urgent:
+        self._jobs.appendleft(job)
+      else:
+        self._prefetch.add(job)
+        self._jobs.append(job)
+      self._cond.notify()
+
+  def drop_prefetch(self):
+    # forget queued prefetch jobs, e.g. for a selection no longer shown
+    with self._cond:
+      if self._prefetch:
+        self._jobs = deque(job for job in self._jobs if job not in self._prefetch)
+        self._pending -= self._prefetch
+        self._prefetch.clear()
+
+  def stop(self):
+    with self._cond:
+      self._stopped = True
+      self._cond.notify()
+    self.wait()
+
+  def run(self):
+    while True:
+      with self._cond:
+        while not self._jobs and not self._stopped:
+          self._cond.wait()
+        if self._stopped:
+          return
+        job = self._jobs.popleft()
+        self._prefetch.discard(job)
+
+      path, height = job
+      if self.store:
+        image = self.store.load(path, height)
+      else:
+        image = QImage(path)
+        if not image.isNull():
+          image = image.scaledToHeight(height, PySide2.QtCore.Qt.SmoothTransformation)
+
+      with self._cond:
+        self._pending.discard(job)
+      self.loaded.emit(path, height, image)
+
+
+class NoteSaver(QThread):
+  # write-behind saving of notes. Pending writes are coalesced per file
+  # (newest text wins) and written in batches off the GUI thread.
+  # Saves are optimistic: a file changed by someone else since the edit
+  # started is not overwritten, conflict is emitted instead
+  saved = Signal(str, object) # path, (version, text) now on disk
+  failed = Signal(str, str)
+  conflict = Signal(str, object) # path, {'base', 'mine', 'theirs', 'version'}
+
+  def __init__(self, policy, parent=None):
+    super().__init__(parent)
+    self.policy = policy # BackupStore arguments
+    self._pending = OrderedDict() # path -> (text, base)
+    self._writing = {} # the batch being written
+    self._written = {} # path -> (version, text) of our last save
+    self._cond = threading.Condition()
+    self._stopped = False
+
+  def enqueue(self, path, text, base=None):
+    # base: (version, text) the edit started from, None skips the check
+    with self._cond:
+      self._pending.pop(path, None)
+      self._pending[path] = (text, base)
+      self._cond.notify_all()
+
+  def pending_text(self, path):
+    # text queued for path but maybe not on disk yet, or None
+    with self._cond:
+      entry = self._pending.get(path) or self._writing.get(path)
+      return entry[0] if entry else None
+
+  def flush(self):
+    # block until everything queued so far is on disk
+    with self._cond:
+      while self._pending or self._writing:
+        self._cond.wait()
+
+  def stop(self):
+    self.flush()
+    with self._cond:
+      self._stopped = True
+      self._cond.notify_all()
+    self.wait()
+
+  def _changed_since(self, path, base, text):
+    # our own earlier saves of path are not a conflict, the GUI may not
+    # have seen their saved signal yet when the next edit was queued
+    version = file_version(path)
+    known = [base]
+    if path in self._written:
+      known.append(self._written[path])
+    if version in [known_version for known_version, text in known]:
+      return False
+
+    newest = max(known, key=lambda entry: entry[0] or (0, 0))
+    self.conflict.emit(path, {
+      'base': newest[1] or '',
+      'mine': text,
+      'theirs': read_text(path) or '',
+      'version': version,
+    })
+    return True
+
+  def run(self):
+    while True:
+      with self._cond:
+        while not self._pending and not self._stopped:
+          self._cond.wait()
+        if self._stopped and not self._pending:
+          return
+        self._writing = dict(self._pending)
+        self._pending.clear()
+
+      for path, (text, base) in self._writing.items():
+        try:
+          if base is not None and self._changed_since(path, base, text):
+            continue
+          save_with_backup(path, text, **self.policy)
+          written = (file_version(path), text)
+          self._written[path] = written
+          self.saved.emit(path, written)
+        except OSError as e:
+          self.failed.emit(path, str(e))
+
+      with self._cond:
+        self._writing = {}
+        self._cond.notify_all()
+
+
+class LoadWorker(QThread):
+  # runs one load function off the GUI thread. The function gets an
+  # is_cancelled callable as last argument; stale results are dropped
+  # by comparing the generation in FreeCADtest._on_load_done
+  done = Signal(int, object)
+
+  def __init__(self, generation, func, *args):
+    super().__init__()
+    self.generation = generation
+    self.func = func
+    self.args = args
+
+  def run(self):
+    try:
+      with profile.span(self.func.__name__):
+        result = self.func(*self.args, self.isInterruptionRequested)
+    except Exception as e:
+      result = e
+    self.done.emit(self.generation, result)
+
 
 class FreeCADtest:
   def __init__(self):
+    self.product_model = ProductModel()
     self.components = {}
     self.testpoints = {}
     self.pictures = []
@@ -27,6 +494,8 @@ class FreeCADtest:
     self._test_info_dirty = False
     self._comp_tp_info_dirty = False
     self._picture_info_dirty = False
+    self.note_versions = {} # path -> (version, text) the editors started from
+    self._conflicts = []
     self.teststeps_path = None
     
     self.current_selection = None
@@ -34,7 +503,40 @@ class FreeCADtest:
     self.current_components = {}
     self.current_testpoints = {}
     
-    self.model = {}
+    self.model = ModelIndex()
+    self.model_observer = ModelObserver(self.model)
+    FreeCAD.addDocumentObserver(self.model_observer)
+
+    self.notes = NotesIndex()
+
+    # 3D view -> tree lookups, rebuilt when the model records change
+    self.board = {}
+    self._board_records = None
+    self._view_callback = None
+    self._press_pos = None
+
+    self.notes_overlay = NotesOverlay()
+    self.refdes_index = RefdesIndex()
+    self.notes_search = None
+    self.notes_indexer = None
+
+    # product folders and the current selection are watched for outside edits
+    self.watcher = PySide2.QtCore.QFileSystemWatcher()
+    self.watcher.directoryChanged.connect(self.on_directory_changed)
+    self.watcher.fileChanged.connect(self.on_file_changed)
+    self._watched_selection = []
+
+    # product and test loads run in LoadWorkers, newest generation wins
+    self._load_generation = 0
+    self._load_workers = []
+
+    self.pixmap_cache = PixmapCache(PIXMAP_CACHE_BYTES)
+    self._report_worker = None
+    self._discovery_workers = []
+    self.catalogued = {} # product name -> catalogue entry
+    self.product_name = None # product the trees and test folders belong to
+    self._closed = False
+    self._wanted_picture = None
 
 
     # load UI
@@ -47,15 +549,41 @@ class FreeCADtest:
     # get settings from registry
     programbase = 'pcb_navigator'
     self.settings = PySide2.QtCore.QSettings('KD', programbase)
+    self._setup_logging()
 
     if self.settings.value("products_path") != None:
-      self.log('Found settings in registry')
+      log.debug('found settings in registry')
       self.products_path = self.settings.value("products_path")
     else:
-      self.log('No settings in registry')
+      log.debug('no settings in registry')
       self.products_path = os.path.join(self.script_path,"products")
     
-    self.log(self.products_path)
+    log.debug('products path: %s', self.products_path)
+
+    # local thumbnail store, previews never read the originals on the share
+    cache_location = PySide2.QtCore.QStandardPaths.writableLocation(PySide2.QtCore.QStandardPaths.CacheLocation)
+    self.profile_path = None
+    if self.settings.value("profile", 'false') in (True, 'true'):
+      self.profile_path = os.path.join(cache_location, programbase, 'profile_%s.json'%time.strftime('%Y%m%d_%H%M%S'))
+    thumbnail_budget = int(self.settings.value("thumbnail_cache_mb", THUMBNAIL_CACHE_MB))*1024*1024
+    self.thumbnails = ThumbnailStore(os.path.join(cache_location, programbase, 'thumbnails'), thumbnail_budget)
+    self.catalogue = ProductCatalogue(os.path.join(cache_location, programbase, CATALOGUE_FILE))
+
+    self.note_saver = NoteSaver(self._backup_policy())
+    self.note_saver.saved.connect(self._on_note_saved, PySide2.QtCore.Qt.QueuedConnection)
+    self.note_saver.failed.connect(self._on_note_save_failed, PySide2.QtCore.Qt.QueuedConnection)
+    self.note_saver.conflict.connect(self._on_note_conflict, PySide2.QtCore.Qt.QueuedConnection)
+    self.note_saver.start()
+
+    # debounced autosave, restarted by every edit
+    self.autosave_timer = PySide2.QtCore.QTimer()
+    self.autosave_timer.setSingleShot(True)
+    self.autosave_timer.setInterval(int(self.settings.value("autosave_ms", AUTOSAVE_MS)))
+    self.autosave_timer.timeout.connect(self.save_information)
+
+    self.picture_loader = PictureLoader(self.thumbnails)
+    self.picture_loader.loaded.connect(self._on_picture_loaded, PySide2.QtCore.Qt.QueuedConnection)
+    self.picture_loader.start()
 
     
     # connect signals
@@ -63,12 +591,16 @@ class FreeCADtest:
     self.form.cb_test.currentTextChanged.connect(self.on_test_changed)
 
     self.form.tw_components.itemExpanded.connect(self.on_page_expanded)
-    self.form.tw_components.itemClicked.connect(self.on_component_clicked)
+    # timed slots take *args, so pass exactly what they use
+    self.form.tw_components.itemClicked.connect(lambda item, column: self.on_component_clicked(item))
 
-    self.form.tw_testpoints.itemClicked.connect(self.on_tp_clicked)
+    self.form.tw_testpoints.itemExpanded.connect(self.on_page_expanded)
+    self.form.tw_testpoints.itemClicked.connect(lambda item, column: self.on_tp_clicked(item))
 
     self.form.pb_next.clicked.connect(lambda : self.on_change_picture())
     self.form.pb_prev.clicked.connect(lambda : self.on_change_picture(-1))
+    self.form.pb_full_size.clicked.connect(self.on_pb_full_size)
+    self.form.lw_thumbnails.itemClicked.connect(self.on_thumbnail_clicked)
 
     self.form.pb_save.clicked.connect(self.on_pb_save)
     self.form.pb_browse.clicked.connect(self.on_pb_browse)
@@ -76,6 +608,16 @@ class FreeCADtest:
     self.form.pb_add_pictures.clicked.connect(self.on_pb_add_pictures)
     self.form.pb_add_test.clicked.connect(self.on_pb_add_test)
     self.form.pb_edit_test.clicked.connect(self.on_pb_edit_test)
+    self.form.pb_export_report.clicked.connect(self.on_pb_export_report)
+    self.form.destroyed.connect(self._on_form_destroyed)
+
+    self.form.le_search.textChanged.connect(self.on_search_changed)
+    self.form.le_search.returnPressed.connect(self.on_search_return)
+    self.form.cb_notes_only.toggled.connect(self.on_search_changed)
+
+    self.form.pb_search_notes.clicked.connect(self.on_pb_search_notes)
+
+    self.form.cb_notes_overlay.toggled.connect(self.on_notes_overlay_toggled)
 
     self.form.pb_flip.clicked.connect(self.on_pb_flip)
     self.form.pb_view_fit.clicked.connect(self.on_pb_view_fit)
@@ -88,6 +630,8 @@ class FreeCADtest:
     self.form.tw_testpoints.setHeaderLabels(["Page","notes"])
 
 
+    self.form.progress_load.setVisible(False)
+
     # populate products
     self._clear_product()
     self._load_products()
@@ -105,31 +649,99 @@ class FreeCADtest:
 
     # initi view
     Gui.SendMsgToActiveView("ViewFit")
+    self._install_view_callback()
 
     if Gui.activeDocument():
       Gui.activeDocument().activeView().viewTop()
 
 
-  def log(self, msg):
-    print(msg)
-
-  def closeEvent(self, event):
-    self.log('closeEvent')
+  def _setup_logging(self):
+    # "log_level" setting: DEBUG, INFO, WARNING or ERROR. Running the
+    # macro again must not add a second handler
+    for handler in list(log.handlers):
+      if isinstance(handler, ConsoleHandler):
+        log.removeHandler(handler)
+    handler = ConsoleHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%H:%M:%S'))
+    log.addHandler(handler)
+    level = str(self.settings.value("log_level", LOG_LEVEL)).upper()
+    try:
+      log.setLevel(level)
+    except ValueError:
+      log.setLevel(LOG_LEVEL)
+      log.warning('unknown log_level %r, using %s', level, LOG_LEVEL)
+    log.propagate = False
+
+  def _dump_profile(self):
+    # per-session timing of the handlers, when the "profile" setting is on
+    if self.profile_path is None:
+      return
+    log.info('profile:\n%s', profile.report())
+    try:
+      profile.dump(self.profile_path)
+      log.info('profile written to %s', self.profile_path)
+    except OSError as e:
+      log.error('writing profile failed: %s', e)
+
+  # task panel buttons; FreeCADtest is no QWidget, closeEvent never runs
+  def accept(self):
+    self._teardown()
+    Gui.Control.closeDialog()
+    return True
+
+  def reject(self):
+    self._teardown()
+    Gui.Control.closeDialog()
+    return True
+
+  def _on_form_destroyed(self, *args):
+    # panel closed some other way, e.g. by another task dialog
+    self._teardown()
+
+  def _teardown(self):
+    if self._closed:
+      return
+    self._closed = True
+    log.debug('closing panel')
     self.settings.setValue("products_path", self.products_path)
-
-    PySide2.QtCore.QCoreApplication.exit()
+    FreeCAD.removeDocumentObserver(self.model_observer)
+    self._remove_view_callback()
+    self.notes_overlay.detach()
+    self.picture_loader.stop()
+    for worker in [self._report_worker] + self._discovery_workers + self._load_workers:
+      if worker is not None:
+        worker.requestInterruption()
+        worker.wait()
+    try:
+      self.save_information()
+    except RuntimeError:
+      log.error('panel already deleted, unsaved note edits are lost')
+    self.note_saver.stop()
+    self._stop_notes_indexer()
+    self._dump_profile()
   
   def on_product_changed(self):
-    self.log('on_product_changed')
-    
+    log.debug('on_product_changed')
+
+    # save before the selection, and with it current_folder, is cleared
+    self.save_information()
     self._clear_selection()
     
     product_name = self.form.cb_product.currentText()
+
+    # tests from the catalogue right away, checked when the product is loaded
+    product = self.catalogued.get(product_name)
+    block_state = self.form.cb_test.blockSignals(True)
+    self.form.cb_test.clear()
+    if product:
+      self.form.cb_test.addItems(product['tests'])
+    self.form.cb_test.blockSignals(block_state)
+
     self._load_product(product_name)
 
   
   def on_test_changed(self):
-    self.log('on_test_changed')
+    log.debug('on_test_changed')
 
     # if anything changed in GUI
     self.save_information()
@@ -137,52 +749,45 @@ class FreeCADtest:
     self._clear_selection()
 
     test_name = self.form.cb_test.currentText()
-    self.log('test name from GUI: %s'%test_name)
+    log.debug('test name from GUI: %s', test_name)
+    if self.product_name != self.form.cb_product.currentText():
+      return # product still loading, _apply_product loads the chosen test
     if test_name:
       self._load_test(test_name)
   
+  @timed
   def on_component_clicked(self, item):
     item_name = item.text(0)
-    self.log('on_component_clicked: %s'%item_name)
+    log.debug('on_component_clicked: %s', item_name)
     
-    self._refresh_current_item() # if folder manually deleted
     self.save_information()
 
-    self.form.groupBox_3.setTitle('Information%s'%('       [%s]'%item_name if not item_name in self.components else ''))
+    self.form.groupBox_3.setTitle('Information%s'%('       [%s]'%item_name if not item_name in self.current_components else ''))
     
-    if item_name in self.components:
+    if item_name in self.current_components:
       page_name = item_name
 
       self._set_current_selection(None)
 
-      for refdes in self.components[page_name]:
-        self.add_selection(refdes)
+      # only the parts the test step keeps on this page
+      self.add_selections(self.current_components[page_name])
     else:
       refdes = item_name
       self._update_information(item, force_enable=True)
       self.select(refdes)
       self._set_current_selection(('Components', refdes, item))
   
+  @timed
   def on_tp_clicked(self, item):
     item_name = item.text(0)
-    self.log('on_tp_clicked: %s'%item_name)
+    log.debug('on_tp_clicked: %s', item_name)
 
-    self._refresh_current_item() # if folder manually deleted
     self.save_information()
 
-    self.form.groupBox_3.setTitle('Information%s'%('       [%s]'%item_name if not item_name in self.testpoints else ''))
+    self.form.groupBox_3.setTitle('Information%s'%('       [%s]'%item_name if not item_name in self.current_testpoints else ''))
 
-    if self.form.pb_save.isEnabled():
-      val = self._dlg_box('TP information changed','Save changes?')
 
-      if val == PySide2.QtWidgets.QMessageBox.Yes:
-          self.log("Yes!")
-          self.save_information()
-      else:
-          self.log("No!")
-    self.form.pb_save.setEnabled(False)
-    
-    if item_name not in self.testpoints: # ie.e not a page name
+    if item_name not in self.current_testpoints: # ie.e not a page name
       refdes = item_name
       self._update_information(item, force_enable=True)
       self.select(refdes)      
@@ -192,47 +797,371 @@ class FreeCADtest:
       self._set_current_selection(None)
 
   
+  def on_directory_changed(self, path):
+    log.debug('on_directory_changed: %s', path)
+
+    if path == self.teststeps_path:
+      self._update_test_list()
+    elif path in (self.path.get('Components'), self.path.get('Testpoints')):
+      self._update_notes_state(path)
+    elif path == self.current_folder:
+      self._update_picture_list()
+
+  def on_file_changed(self, path):
+    log.debug('on_file_changed: %s', path)
+
+    # editors that replace the file drop it from the watcher
+    if os.path.isfile(path) and path not in self.watcher.files():
+      self.watcher.addPath(path)
+
+    if self.test_folder and path == os.path.join(self.test_folder, 'readme.txt'):
+      if not self._test_info_dirty:
+        self._reload_textedit(self.form.te_test_info, path)
+    elif self.current_folder and path == os.path.join(self.current_folder, 'readme.txt'):
+      if not self._comp_tp_info_dirty:
+        self._reload_textedit(self.form.te_comp_tp_info, path)
+
+  def _reload_textedit(self, widget, path):
+    try:
+      with open(path) as f:
+        text = f.read()
+    except OSError:
+      return
+    # our own saves land here too, only touch the widget on real changes
+    if text != widget.toPlainText():
+      self._load_textedit_from_file(widget, path, force_enable=True)
+
+  def _update_test_list(self):
+    try:
+      test_steps = [x for x in os.listdir(self.teststeps_path) if os.path.isdir(os.path.join(self.teststeps_path,x))]
+    except OSError:
+      return
+    existing = [self.form.cb_test.itemText(i) for i in range(self.form.cb_test.count())]
+
+    for test_name in existing:
+      if test_name not in test_steps:
+        self.form.cb_test.removeItem(self.form.cb_test.findText(test_name))
+    for test_name in test_steps:
+      if test_name not in existing:
+        self.form.cb_test.addItem(test_name)
+
+  def _update_notes_state(self, path):
+    # update the notes column of the refdes whose folder came or went
+    old_notes = set(self.notes.notes(path))
+    self.notes.refresh(path)
+    new_notes = self.notes.notes(path)
+
+    group = 'Components' if path == self.path.get('Components') else 'Testpoints'
+    for refdes in old_notes ^ new_notes:
+      found = self._find_tree_item(group, refdes, populate=False)
+      if found:
+        found[1].setText(1, 'YES' if refdes in new_notes else '')
+      self._notes_state_changed(refdes, refdes in new_notes)
+
+    if self.current_selection and self.current_selection[1] in old_notes ^ new_notes:
+      self._watch_selection()
+
+  def _update_picture_list(self):
+    if not self.current_selection:
+      return
+    old_pictures = [picture[0] for picture in self.pictures]
+    if list_pictures(self.current_folder) != old_pictures:
+      self._set_pictures(self.current_selection[2])
+      self._next_picture()
+
+  def _watch_product(self, product_path):
+    watched = self.watcher.directories() + self.watcher.files()
+    if watched:
+      self.watcher.removePaths(watched)
+    self._watched_selection = []
+
+    paths = [os.path.join(product_path, folder) for folder in ('teststeps', 'components', 'testpoints')]
+    paths = [path for path in paths if os.path.isdir(path)]
+    if paths:
+      self.watcher.addPaths(paths)
+
+  def _watch_selection(self):
+    if self._watched_selection:
+      self.watcher.removePaths(self._watched_selection)
+
+    paths = []
+    if self.test_folder:
+      paths.append(os.path.join(self.test_folder, 'readme.txt'))
+    if self.current_folder:
+      paths.append(self.current_folder)
+      paths.append(os.path.join(self.current_folder, 'readme.txt'))
+
+    self._watched_selection = [path for path in paths if os.path.exists(path)]
+    if self._watched_selection:
+      self.watcher.addPaths(self._watched_selection)
+
   def on_page_expanded(self, item):
     #PySide2.QtWidgets.Qtw_componentsItem
-    self.log('on_page_expanded: %s'%item.text(0))
+    log.debug('on_page_expanded: %s', item.text(0))
+    if item.parent() is None:
+      self._populate_page(item)
+
+  @timed
+  def on_search_changed(self, *args):
+    text = self.form.le_search.text().strip()
+    notes_only = self.form.cb_notes_only.isChecked()
+
+    # (group, page) -> refdes to show, None for the whole page
+    visible = {}
+    if text or notes_only:
+      for refdes, group, page in self.refdes_index.search(text):
+        visible.setdefault((group, page), set()).add(refdes)
+      for group, page in self.refdes_index.search_pages(text):
+        visible[(group, page)] = None
+    self._filter_tws(visible if (text or notes_only) else None, notes_only, expand=bool(text))
+
+  def on_search_return(self):
+    # jump to the first match, preferring the current tab
+    current = self.form.tw_comm.currentIndex()
+    widgets = [self.form.tw_components, self.form.tw_testpoints]
+    if current == 1:
+      widgets.reverse()
+
+    for widget in widgets:
+      for i in range(widget.topLevelItemCount()):
+        page_item = widget.topLevelItem(i)
+        if page_item.isHidden():
+          continue
+        for j in range(page_item.childCount()):
+          item = page_item.child(j)
+          if not item.isHidden():
+            self._jump_to_item(widget, item)
+            return
+
+  def _jump_to_item(self, widget, item):
+    self.form.tw_comm.setCurrentIndex(0 if widget is self.form.tw_components else 1)
+    item.parent().setExpanded(True)
+    widget.setCurrentItem(item)
+    widget.scrollToItem(item)
+    if widget is self.form.tw_components:
+      self.on_component_clicked(item)
+    else:
+      self.on_tp_clicked(item)
+
+  def _filter_tws(self, visible, notes_only=False, expand=False):
+    # update item visibility in place; visible=None shows everything
+    for widget in [self.form.tw_components, self.form.tw_testpoints]:
+      group = self._tw_group(widget)
+      widget.setUpdatesEnabled(False)
+      for i in range(widget.topLevelItemCount()):
+        page_item = widget.topLevelItem(i)
+        page = page_item.text(0)
+
+        if visible is None:
+          page_item.setHidden(False)
+          for j in range(page_item.childCount()):
+            page_item.child(j).setHidden(False)
+          continue
+
+        if (group, page) not in visible:
+          page_item.setHidden(True)
+          continue
+
+        self._populate_page(page_item)
+        allowed = visible[(group, page)]
+        shown = 0
+        for j in range(page_item.childCount()):
+          item = page_item.child(j)
+          hide = (allowed is not None and item.text(0) not in allowed) or (notes_only and item.text(1) != 'YES')
+          item.setHidden(hide)
+          shown += not hide
+        page_item.setHidden(shown == 0)
+        if expand and shown:
+          page_item.setExpanded(True)
+      widget.setUpdatesEnabled(True)
+
+  def on_pb_search_notes(self, state):
+    if self.notes_search is None:
+      return
 
-  def save_information(self, silent=False):
-    if self._is_dirty() and not silent:
-      choise = self._dlg_box('Information changed','Save changes?')
+    # pick up notes changed since the product was loaded
+    if not self.notes_indexer.isRunning():
+      self.notes_indexer.start()
+
+    dlg = PySide2.QtWidgets.QDialog(self.form)
+    dlg.setWindowTitle('Search notes')
+    le_query = PySide2.QtWidgets.QLineEdit()
+    le_query.setPlaceholderText('e.g. reworked cracked')
+    lw_hits = PySide2.QtWidgets.QListWidget()
+    layout = PySide2.QtWidgets.QVBoxLayout(dlg)
+    layout.addWidget(le_query)
+    layout.addWidget(lw_hits)
+
+    def update_hits(text):
+      lw_hits.clear()
+      for rel_path, kind, name, snippet in self.notes_search.search(text):
+        hit = PySide2.QtWidgets.QListWidgetItem('%s %s: %s'%(kind, name, snippet.replace('\n', ' ')))
+        hit.setData(PySide2.QtCore.Qt.UserRole, (rel_path, kind, name))
+        hit.setToolTip(rel_path)
+        lw_hits.addItem(hit)
+
+    def open_hit(hit):
+      rel_path, kind, name = hit.data(PySide2.QtCore.Qt.UserRole)
+      dlg.accept()
+      self._show_note_hit(rel_path, kind, name)
+
+    le_query.textChanged.connect(update_hits)
+    lw_hits.itemDoubleClicked.connect(open_hit)
+    dlg.resize(600, 400)
+    dlg.exec_()
+
+  def _show_note_hit(self, rel_path, kind, name):
+    if kind == 'Test':
+      self.form.cb_test.setCurrentText(name)
+      return
 
-      if choise == PySide2.QtWidgets.QMessageBox.No:
-          self.log("Abort save")
-          return
+    group = 'Testpoints' if rel_path.startswith('testpoints') else 'Components'
+    found = self._find_tree_item(group, name)
+    if found is None:
+      self._msg_box('Not in current test', '%s is not part of the selected test'%name)
+      return
+    self._jump_to_item(*found)
+
+    if kind == 'Picture':
+      stem = os.path.splitext(os.path.basename(rel_path))[0]
+      for index, picture in enumerate(self.pictures):
+        if os.path.splitext(os.path.basename(picture[0]))[0] == stem:
+          self.on_change_picture(index - self.picture_index)
+          break
+
+  def _find_tree_item(self, group, refdes, populate=True):
+    # (widget, item) for a refdes in the current test, or None
+    widget = self.form.tw_components if group == 'Components' else self.form.tw_testpoints
+    # a refdes can sit on several pages, only some of them in the test
+    for page in self.product_model.pages_of.get(refdes, ()):
+      for page_item in widget.findItems(page, PySide2.QtCore.Qt.MatchExactly, 0):
+        if not populate and not page_item.data(0, PySide2.QtCore.Qt.UserRole):
+          continue # created later with the current notes state
+        self._populate_page(page_item)
+        for j in range(page_item.childCount()):
+          if page_item.child(j).text(0) == refdes:
+            return widget, page_item.child(j)
+    return None
+
+  def _start_notes_indexer(self, product_path):
+    self._stop_notes_indexer()
+    self.notes_search = NotesSearchIndex(product_path)
+    self.notes_indexer = NotesIndexer(self.notes_search)
+    self.notes_indexer.indexed.connect(self._on_notes_indexed, PySide2.QtCore.Qt.QueuedConnection)
+    self.notes_indexer.start()
+
+  def _stop_notes_indexer(self):
+    if self.notes_indexer is not None:
+      self.notes_indexer.requestInterruption()
+      self.notes_indexer.wait()
+      self.notes_indexer = None
+
+  def _on_notes_indexed(self, product_path, updated):
+    log.info('notes index for %s: %d files updated', product_path, updated)
+
+  @timed
+  def save_information(self):
+    # hand dirty notes to the write-behind saver; never waits on the share
+    self.autosave_timer.stop()
 
     if self._test_info_dirty:
       readme_file_path = os.path.join(self.test_folder,"readme.txt")
-
-      self.log('Save %s'%readme_file_path)
       self._save_to_file_and_backup(self.form.te_test_info, readme_file_path)
-
       self._test_info_dirty = False
 
     if self._comp_tp_info_dirty:
       readme_file_path = os.path.join(self.current_folder,"readme.txt")
-
-      self.log('Save %s'%readme_file_path)
       self._save_to_file_and_backup(self.form.te_comp_tp_info, readme_file_path)
-
       self._comp_tp_info_dirty = False
 
     if self._picture_info_dirty:
       picture_path = self.pictures[self.picture_index][0]
       txt_path = os.path.splitext(picture_path)[0] + '.txt'
-      
-      self.log('Save %s'%txt_path)
       self._save_to_file_and_backup(self.form.te_picture_info, txt_path)
-
       self._picture_info_dirty = False
 
-    self._refresh_current_item()
-
     self.form.pb_save.setEnabled(False)
 
+  def _on_note_saved(self, path, written):
+    log.info('saved %s', path)
+    self.note_versions[path] = written
+    if self.current_folder and os.path.dirname(path) == self.current_folder:
+      self._refresh_current_item()
+
+  def _on_note_save_failed(self, path, error):
+    log.error('saving %s failed: %s', path, error)
+    self._msg_box('Save failed', '%s\n%s'%(path, error))
+
+  def _on_note_conflict(self, path, conflict):
+    log.warning('conflict saving %s, changed by someone else', path)
+    # one dialog at a time, exec_ would deliver the next one nested
+    self._conflicts.append((path, conflict))
+    if len(self._conflicts) > 1:
+      return
+    while self._conflicts:
+      self._resolve_conflict(*self._conflicts[0])
+      self._conflicts.pop(0)
+
+  def _resolve_conflict(self, path, conflict):
+    # three-way merge of what the edit started from (base), the file as
+    # it is now (theirs) and the edit (mine). Closing keeps mine; theirs
+    # stays recoverable as a revision in the BackupStore either way
+    merged, has_conflicts = merge3(conflict['base'], conflict['mine'], conflict['theirs'])
+
+    dlg = PySide2.QtWidgets.QDialog(self.form)
+    dlg.setWindowTitle('Note changed by someone else')
+    layout = PySide2.QtWidgets.QVBoxLayout(dlg)
+    layout.addWidget(PySide2.QtWidgets.QLabel('%s was changed since you started editing it.'%path))
+
+    splitter = PySide2.QtWidgets.QSplitter()
+    for title, text in (('Base', conflict['base']), ('Theirs', conflict['theirs']), ('Mine', conflict['mine'])):
+      box = PySide2.QtWidgets.QGroupBox(title)
+      view = PySide2.QtWidgets.QPlainTextEdit(text)
+      view.setReadOnly(True)
+      PySide2.QtWidgets.QVBoxLayout(box).addWidget(view)
+      splitter.addWidget(box)
+    layout.addWidget(splitter)
+
+    if has_conflicts:
+      layout.addWidget(PySide2.QtWidgets.QLabel('Merged, resolve the parts between <<<<<<< and >>>>>>>:'))
+    else:
+      layout.addWidget(PySide2.QtWidgets.QLabel('Merged:'))
+    te_result = PySide2.QtWidgets.QPlainTextEdit(merged)
+    layout.addWidget(te_result)
+
+    buttons = PySide2.QtWidgets.QDialogButtonBox()
+    pb_merged = buttons.addButton('Save merged', PySide2.QtWidgets.QDialogButtonBox.AcceptRole)
+    pb_theirs = buttons.addButton('Keep theirs', PySide2.QtWidgets.QDialogButtonBox.AcceptRole)
+    buttons.addButton('Keep mine', PySide2.QtWidgets.QDialogButtonBox.RejectRole)
+    buttons.accepted.connect(dlg.accept)
+    buttons.rejected.connect(dlg.reject)
+    layout.addWidget(buttons)
+    dlg.resize(1000, 700)
+    dlg.exec_()
+
+    theirs = (conflict['version'], conflict['theirs'])
+    if buttons.clickedButton() is pb_theirs:
+      text = conflict['theirs']
+      self.note_versions[path] = theirs
+    else:
+      text = te_result.toPlainText() if buttons.clickedButton() is pb_merged else conflict['mine']
+      self.note_saver.enqueue(path, text, theirs)
+
+    widget = self._note_widget(path)
+    if widget is not None and widget.toPlainText() != text:
+      self._set_textedit_text(widget, text)
+
+  def _note_widget(self, path):
+    # the editor currently showing the note at path, if any
+    if self.test_folder and path == os.path.join(self.test_folder, 'readme.txt'):
+      return self.form.te_test_info
+    if self.current_folder and path == os.path.join(self.current_folder, 'readme.txt'):
+      return self.form.te_comp_tp_info
+    if self.pictures and 0 <= self.picture_index < len(self.pictures):
+      if path == os.path.splitext(self.pictures[self.picture_index][0])[0] + '.txt':
+        return self.form.te_picture_info
+    return None
+
   def on_pb_add_pictures(self, state):
     # if anything changed in GUI
     self.save_information()
@@ -244,51 +1173,149 @@ class FreeCADtest:
       if choise == PySide2.QtWidgets.QMessageBox.Yes:
         self._make_info_folder(self.current_folder)
       else:
-        self.log("Make new folder canceled")
+        log.debug("make new folder canceled")
         return
 
     filters = "Images (*.png *.jpg)"
     filenames = PySide2.QtWidgets.QFileDialog.getOpenFileNames(self.form, "","", filters)[0]
-    self.log(filenames)
-
-    for src_file_path in filenames:
-      # copy picture
-      src_file_name = os.path.split(src_file_path)[1]
-      dst_file_path = os.path.join(self.current_folder, src_file_name)
-      shutil.copyfile(src_file_path, dst_file_path)
-
-      # add empty picture description file
-      info_file_name = os.path.splitext(src_file_name)[0] + '.txt'
-      info_file_path = os.path.join(self.current_folder, info_file_name)
-      with open(info_file_path, "w") as f:pass
-    
-    # update information for selected item
-    self._update_information(self.current_selection[2])
+    log.debug('adding pictures: %s', filenames)
+    if not filenames:
+      return
 
+    # copy on a worker pool, the dialog only polls the futures
+    make_display_copy = self._make_display_copy if self.form.cb_display_copy.isChecked() else None
+    importer = PictureImport(self.current_folder, make_display_copy)
+    executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS)
+    futures = [executor.submit(importer.import_one, path) for path in filenames]
+    executor.shutdown(wait=False)
+
+    dlg = PySide2.QtWidgets.QProgressDialog('Importing pictures...', 'Cancel', 0, len(futures), self.form)
+    dlg.setWindowModality(PySide2.QtCore.Qt.WindowModal)
+    dlg.setMinimumDuration(0)
+    dlg.canceled.connect(lambda: [future.cancel() for future in futures])
+
+    timer = PySide2.QtCore.QTimer(dlg)
+    def poll():
+      done = sum(future.done() for future in futures)
+      dlg.setValue(done)
+      if done == len(futures):
+        timer.stop()
+        dlg.reset()
+        self._on_pictures_imported(filenames, futures)
+    timer.timeout.connect(poll)
+    timer.start(100)
+
+  def _make_display_copy(self, picture_path, display_path):
+    # runs on an import thread; QImage is safe to use off the GUI thread
+    image = QImage(picture_path)
+    if image.isNull() or image.height() <= DISPLAY_COPY_HEIGHT:
+      return
+    image.scaledToHeight(DISPLAY_COPY_HEIGHT, PySide2.QtCore.Qt.SmoothTransformation).save(display_path, 'JPG', 90)
+
+  def _on_pictures_imported(self, filenames, futures):
+    copied = []
+    duplicates = []
+    failed = []
+    for src_file_path, future in zip(filenames, futures):
+      if future.cancelled():
+        continue
+      if future.exception():
+        failed.append('%s: %s'%(os.path.basename(src_file_path), future.exception()))
+        continue
+      status, dst_file_path = future.result()
+      (copied if status == 'copied' else duplicates).append((src_file_path, dst_file_path))
+
+    log.info('imported %d pictures, %d duplicates, %d failed', len(copied), len(duplicates), len(failed))
+
+    # update information for selected item
+    if self.current_selection:
+      self._update_information(self.current_selection[2])
     self._refresh_current_item()
 
+    if duplicates or failed:
+      lines = ['%s already stored as %s'%(os.path.basename(src), os.path.basename(dst)) for src, dst in duplicates]
+      self._msg_box('Pictures imported', '%d copied\n%s'%(len(copied), '\n'.join(lines + failed)))
+
 
   def on_pb_add_test(self, state):
-    self.log('on_pb_add_test')
+    log.debug('on_pb_add_test')
 
     # if anything changed in GUI
     self.save_information()
 
     product_name = self.form.cb_product.currentText()
     test_name, ok = PySide2.QtWidgets.QInputDialog.getText(self.form, 'text', 'Enter some text')
-    self.log(test_name)
+    log.debug('new test: %s', test_name)
     if ok:
       new_test_folder = os.path.join(self.teststeps_path,test_name)
       if os.path.isdir(new_test_folder):
         self._msg_box('Test already exsist',test_name+' '*50)
       else:
-        self.log('ok')
         self._make_test_folder(product_name, test_name)
         self._load_product(product_name)
 
 
+  def on_pb_export_report(self, state):
+    if not self.test_folder:
+      return
+
+    # the report reads the notes from disk
+    self.save_information()
+    self.note_saver.flush()
+
+    product_name = self.form.cb_product.currentText()
+    test_name = self.form.cb_test.currentText()
+    title = '%s - %s'%(product_name, test_name)
+    default_path = os.path.join(os.path.expanduser('~'), '%s.html'%title)
+    report_path = PySide2.QtWidgets.QFileDialog.getSaveFileName(self.form, 'Export report', default_path, 'HTML (*.html)')[0]
+    if not report_path:
+      return
+
+    entries = report_entries({'Components': self.current_components, 'Testpoints': self.current_testpoints},
+                             self.path, self.notes)
+    readme = read_text(os.path.join(self.test_folder, 'readme.txt'))
+
+    # written by a worker, the dialog only polls how far it got
+    written = [0]
+    worker = LoadWorker(0, write_report, report_path, title, readme, entries, self._report_thumbnail,
+                        REPORT_WORKERS, lambda n: written.__setitem__(0, n))
+    self._report_worker = worker
+
+    dlg = PySide2.QtWidgets.QProgressDialog('Writing report...', 'Cancel', 0, len(entries), self.form)
+    dlg.setWindowModality(PySide2.QtCore.Qt.WindowModal)
+    dlg.setMinimumDuration(0)
+    dlg.canceled.connect(worker.requestInterruption)
+
+    timer = PySide2.QtCore.QTimer(dlg)
+    timer.timeout.connect(lambda: dlg.setValue(written[0]))
+
+    def done(generation, result):
+      timer.stop()
+      dlg.reset()
+      self._report_worker = None
+      if isinstance(result, Exception):
+        log.error('report failed: %s', result)
+        self._msg_box('Report failed', '%s\n%s'%(report_path, result))
+      elif result is not None:
+        log.info('report %s written, %d refdes, %d pictures', report_path, len(entries), result)
+        PySide2.QtGui.QDesktopServices.openUrl(PySide2.QtCore.QUrl.fromLocalFile(report_path))
+    worker.done.connect(done, PySide2.QtCore.Qt.QueuedConnection)
+
+    timer.start(100)
+    worker.start()
+
+  def _report_thumbnail(self, picture_path):
+    # runs on a report thread: jpeg bytes of a thumbnail from the local store
+    image = self.thumbnails.load(picture_path, REPORT_THUMBNAIL_HEIGHT)
+    if image.isNull():
+      return None
+    buffer = PySide2.QtCore.QBuffer()
+    buffer.open(PySide2.QtCore.QIODevice.WriteOnly)
+    image.save(buffer, 'JPG', 80)
+    return bytes(buffer.data())
+
   def on_pb_edit_test(self, state):
-    self.log('on_pb_edit_test')
+    log.debug('on_pb_edit_test')
 
     # if anything changed in GUI
     self.save_information()
@@ -299,6 +1326,7 @@ class FreeCADtest:
       self._msg_box('Config file not found',config_file)
       return
     
+    import subprocess
     p = subprocess.Popen(["notepad.exe", config_file])
     p.wait() # wait for editor to close
     self._load_test(test_name)
@@ -309,28 +1337,28 @@ class FreeCADtest:
     self.save_information()
 
     refdes = self.current_selection[1]
-    self.log('on_pb_open_folder')
+    log.debug('on_pb_open_folder')
     if not os.path.isdir(self.current_folder):
       choise = self._dlg_box('No information for current selection', 'Add folder for %s?'% refdes)
       if choise == PySide2.QtWidgets.QMessageBox.Yes:
         self._make_info_folder(self.current_folder)
-        self.save_information(silent=True)
+        self.save_information()
         self._refresh_current_item()
         self._open_folder(self.current_folder)
       else:
-        self.log("Make new folder canceled")
+        log.debug("make new folder canceled")
     else:
-      self.save_information(silent=True)
+      self.save_information()
       self._open_folder(self.current_folder)
 
 
   def on_pb_view_fit(self, state):
-    self.log('on_pb_view_fit')
+    log.debug('on_pb_view_fit')
     Gui.SendMsgToActiveView("ViewFit")
 
 
   def on_pb_flip(self, state):
-    self.log('on_pb_flip')
+    log.debug('on_pb_flip')
     #cam = Gui.ActiveDocument.ActiveView.getCameraNode()
     #cam_pos = cam.position.getValue().getValue()
     #cam.position.setValue(0,0,0)
@@ -348,7 +1376,8 @@ class FreeCADtest:
   def on_pb_browse(self, state):
     folder = PySide2.QtWidgets.QFileDialog.getExistingDirectory(None, "Select Folder")
     if folder:
-      self.log(folder)
+      log.info('products path: %s', folder)
+      self.save_information()
       self.products_path = folder
       self._clear_product()
       self._load_products()
@@ -361,118 +1390,277 @@ class FreeCADtest:
     self.save_information()
     self._next_picture(direction)
 
+  def on_thumbnail_clicked(self, item):
+    index = self.form.lw_thumbnails.row(item)
+    if index != self.picture_index:
+      self.on_change_picture(index - self.picture_index)
+
+  def on_pb_full_size(self, state):
+    # the original is only read from the share when asked for
+    if not self.pictures:
+      return
+    picture_path = self.pictures[self.picture_index][0]
+
+    dlg = PySide2.QtWidgets.QDialog(self.form)
+    dlg.setWindowTitle(os.path.basename(picture_path))
+    label = PySide2.QtWidgets.QLabel()
+    label.setPixmap(QPixmap(picture_path))
+    scroll = PySide2.QtWidgets.QScrollArea()
+    scroll.setWidget(label)
+    layout = PySide2.QtWidgets.QVBoxLayout(dlg)
+    layout.addWidget(scroll)
+    dlg.resize(1024, 768)
+    dlg.exec_()
+
   def on_test_info_changed(self):
-    self.log('on_test_info_changed')
     self._test_info_dirty = True
     self.form.pb_save.setEnabled(True)
+    self.autosave_timer.start()
 
   def on_comp_tp_info_changed(self):
-    self.log('on_comp_tp_info_changed')
     self._comp_tp_info_dirty = True
     if self.current_selection:
       self.form.pb_save.setEnabled(True)
+      self.autosave_timer.start()
 
   def on_picture_info_changed(self):
-    self.log('on_picture_info_changed')
     self._picture_info_dirty = True
     if self.current_selection:
       self.form.pb_save.setEnabled(True)
+      self.autosave_timer.start()
 
-  def _parse_active_document(self):
-        
-    self.model = {}
-
-    self.model['components'] = {}
-    self.model['testpoints'] = {}
-    self.model['symbols'] = {}
-
-    components = FreeCAD.ActiveDocument.getObject('Components')
-    placebounds = FreeCAD.ActiveDocument.getObject('PlaceBound')
-
-    layers = ['Top', 'Bottom']
-
-    for layer in layers:
-      comps = components.getObject('Components%s'%layer)
-      for name in comps.getSubObjects():
-        obj_name = name.strip('.')
-        obj = comps.getObject(obj_name)
-
-        refdes = obj_name
-        self.model['symbols'][refdes] = (obj, layer)
-
-        if refdes.startswith('TP'):
-          self.model['testpoints'][refdes] = (obj, layer)
-        else:
-          self.model['components'][refdes] = (obj, layer)
-
-      placebound = placebounds.getObject('PlaceBound%s'%layer)
-      if placebound == None:
-        continue
-      for feaure_name in placebound.getSubObjects():
-        obj = placebound.getObject(feaure_name.strip('.'))
-        refdes = obj.Label[obj.Label.index('_')+1:]
-
-        self.model['symbols'][refdes] = (obj, layer)
-        self.model['testpoints'][refdes] = (obj, layer)
-
-    self.log(self.model)
-
-
+  @timed
   def select(self, refdes):
     if not Gui.activeDocument():
       return
     
     Gui.Selection.clearSelection()
 
-    self._parse_active_document()
-
-    
-    (obj, layer) = self.model['symbols'][refdes]
+    (obj, layer, obj_postition) = self.model.get(FreeCAD.ActiveDocument, refdes)
 
     Gui.Selection.addSelection(obj)
-    obj_postition = obj.Shape.BoundBox.Center
-    self.log(obj.Label)
+    log.debug('select %s', obj.Label)
 
     if self.form.cb_pan_selection.isChecked():
       cam = Gui.ActiveDocument.ActiveView.getCameraNode()
       cam.position.setValue(obj_postition)
 
     if self.form.cb_auto_flip.isChecked():
-      self.log('switch to %s'%layer)
+      log.debug('switch to %s', layer)
       self.form.pb_flip.setChecked(layer=='Bottom')
       self.on_pb_flip(layer=='Bottom')
 
+  def add_selections(self, names):
+    if not Gui.activeDocument():
+      return
 
-  def add_selection(self, name):
+    # hold back scene graph notifications so the viewer redraws once per batch
+    root = Gui.ActiveDocument.ActiveView.getSceneGraph()
+    notify = root.enableNotify(False)
+    try:
+      for name in names:
+        obj = self.model.by_label(FreeCAD.ActiveDocument, name)
+        if obj is not None:
+          Gui.Selection.addSelection(obj)
+    finally:
+      root.enableNotify(notify)
+      root.touch()
+
+  def on_notes_overlay_toggled(self, state):
+    log.debug('on_notes_overlay_toggled: %d', state)
+    if state:
+      self._update_notes_overlay()
+    self.notes_overlay.set_visible(state)
+
+  def _update_notes_overlay(self):
+    # all annotated parts of the product in one batch
+    doc = FreeCAD.ActiveDocument
+    if doc is None or not Gui.activeDocument() or not self.path:
+      return
+    try:
+      self.model.ensure(doc)
+    except AttributeError:
+      return # not a board document
+
+    markers = {}
+    for group in ('Components', 'Testpoints'):
+      for refdes in self.notes.notes(self.path[group]):
+        record = self.model.records.get(refdes)
+        if record:
+          markers[refdes] = marker_position(record)
+    self.notes_overlay.set_markers(markers)
+    self.notes_overlay.attach(Gui.activeDocument().activeView())
+
+  def _notes_state_changed(self, refdes, state):
+    # keep the overlay in step with a single part's notes folder
+    if not self.form.cb_notes_overlay.isChecked():
+      return
+    record = self.model.records.get(refdes)
+    if record:
+      self.notes_overlay.set_marker(refdes, *marker_position(record), state)
+
+  def _install_view_callback(self):
+    # follow clicks in the 3D view for the reverse (view -> tree) lookup
     if not Gui.activeDocument():
       return
-    
-    for obj in FreeCAD.ActiveDocument.Objects:
-      if obj.Label == name:
-        Gui.Selection.addSelection(obj)
-        break
+    view = Gui.activeDocument().activeView()
+    if self._view_callback and self._view_callback[0] is view:
+      return
+    self._remove_view_callback()
+    callback = view.addEventCallback("SoMouseButtonEvent", self.on_view_mouse)
+    self._view_callback = (view, callback)
+
+  def _remove_view_callback(self):
+    if self._view_callback:
+      view, callback = self._view_callback
+      try:
+        view.removeEventCallback("SoMouseButtonEvent", callback)
+      except Exception:
+        pass # view already closed
+      self._view_callback = None
+
+  @timed
+  def on_view_mouse(self, event):
+    # click: nearest part, shift+drag: every part in the rectangle
+    if event['Button'] != 'BUTTON1':
+      return
+    if event['State'] == 'DOWN':
+      self._press_pos = (event['Position'], event['ShiftDown'])
+      return
+    if event['State'] != 'UP' or self._press_pos is None:
+      return
 
-  def _load_products(self):
-    self.log(self.products_path)
-    products = [folder for folder in os.listdir(self.products_path) if os.path.isfile(os.path.join(self.products_path, folder, 'components.txt'))]
+    (start, shift), end = self._press_pos, event['Position']
+    self._press_pos = None
+    dragged = max(abs(start[0] - end[0]), abs(start[1] - end[1])) > CLICK_SLOP
+    if dragged and not shift:
+      return # orbit or pan, not a click
+    view = self._view_callback[0]
+    board = self._board_layer()
+    if board is None:
+      return
+
+    if dragged:
+      p0 = view.getPoint(*start)
+      p1 = view.getPoint(*end)
+      refdes_list = sorted(board.query_rect(p0.x, p0.y, p1.x, p1.y))
+    else:
+      point = view.getPoint(*end)
+      refdes = board.nearest(point.x, point.y, max_distance=board.cell_size)
+      refdes_list = [refdes] if refdes else []
+
+    log.debug('view pick: %s', refdes_list)
+    self._reveal_in_trees(refdes_list)
+
+  def _board_layer(self):
+    # spatial index of the layer facing the camera
+    doc = FreeCAD.ActiveDocument
+    if doc is None:
+      return None
+    try:
+      self.model.ensure(doc)
+    except AttributeError:
+      return None # not a board document
+    if self.model.records is not self._board_records:
+      self.board = board_index(self.model.records)
+      self._board_records = self.model.records
+    return self.board.get('Bottom' if self.form.pb_flip.isChecked() else 'Top')
+
+  def _reveal_in_trees(self, refdes_list):
+    # select and scroll to the tree items of the picked parts
+    found = []
+    for refdes in refdes_list:
+      origin = self.model.records[refdes][2]
+      group = 'Testpoints' if refdes.startswith('TP') or origin == 'PlaceBound' else 'Components'
+      item = self._find_tree_item(group, refdes)
+      if item:
+        found.append(item)
+
+    if not found:
+      return
+
+    for widget in [self.form.tw_components, self.form.tw_testpoints]:
+      widget.clearSelection()
+
+    first_widget, first_item = found[0]
+    self.form.tw_comm.setCurrentIndex(0 if first_widget is self.form.tw_components else 1)
+    for widget, item in found:
+      item.parent().setExpanded(True)
+      item.setSelected(True)
+    first_widget.scrollToItem(first_item)
 
+  def _load_products(self):
+    log.debug('products path: %s', self.products_path)
     self.form.le_products_path.setText(self.products_path)
     self._clear_product()
-    
-    if len(products):
-      self.form.cb_product.addItems(products)
 
-      # HACK: can't trigger on closeEvent()
-      # store settings in registry
-      self.settings.setValue("products_path", self.products_path)
+    # show the catalogued products at once, changes on the share are
+    # picked up in the background
+    products = self.catalogue.products(self.products_path)
+    if products:
+      self._set_products(products)
+
+    products_path = self.products_path
+    worker = LoadWorker(0, self.catalogue.refresh, products_path)
+    worker.done.connect(lambda generation, result: self._on_products_listed(worker, products_path, result),
+                        PySide2.QtCore.Qt.QueuedConnection)
+    self._discovery_workers.append(worker)
+    worker.start()
+
+  def _set_products(self, products):
+    self.form.cb_product.addItems([product['name'] for product in products])
+    self._set_product_tooltips(products)
+
+    # HACK: can't trigger on closeEvent()
+    # store settings in registry
+    self.settings.setValue("products_path", self.products_path)
+
+    self.form.gb_operation.setEnabled(True)
 
-      self.form.gb_operation.setEnabled(True)
-    else:
+  def _on_products_listed(self, worker, products_path, products):
+    self._discovery_workers.remove(worker)
+    if products_path != self.products_path or products is None:
+      return # browsed elsewhere meanwhile
+    if isinstance(products, Exception):
+      log.error('listing products in %s failed: %s', products_path, products)
+      products = []
+
+    shown = [self.form.cb_product.itemText(i) for i in range(self.form.cb_product.count())]
+    if [product['name'] for product in products] == shown:
+      self._set_product_tooltips(products)
+      return
+    if not products:
+      self._clear_product()
       self._msg_box('Warning', 'No valid product folders found')
+      return
+    if not shown:
+      self._set_products(products)
+      return
+
+    # bring the catalogued list up to date, the loaded product stays if it still exists
+    names = [product['name'] for product in products]
+    for product_name in shown:
+      if product_name not in names:
+        self.form.cb_product.removeItem(self.form.cb_product.findText(product_name))
+    for i, product_name in enumerate(names):
+      if self.form.cb_product.findText(product_name) < 0:
+        self.form.cb_product.insertItem(i, product_name)
+    self._set_product_tooltips(products)
+
+  def _set_product_tooltips(self, products):
+    for product in products:
+      self.catalogued[product['name']] = product
+      i = self.form.cb_product.findText(product['name'])
+      tests = product['tests']
+      tooltip = '%d pages, %d components, %d testpoints\n%d with notes\n%d tests%s'%(
+        product['pages'], product['components'], product['testpoints'], product['notes'],
+        len(tests), (': ' + ', '.join(tests)) if tests else '')
+      self.form.cb_product.setItemData(i, tooltip, PySide2.QtCore.Qt.ToolTipRole)
 
   
+  @timed
   def _load_product(self, product_name):
-    self.log('_load_product: %s'%product_name)
+    log.debug('_load_product: %s', product_name)
 
     # if anything changed in GUI
     self.save_information()
@@ -480,70 +1668,118 @@ class FreeCADtest:
     if not product_name:
       return
 
-    # get components per page
-    prodfile = os.path.join(self.products_path, product_name, "components.txt")
-
-    if os.path.isfile(prodfile):
-      f = open(prodfile)
-      lines = f.readlines()
-      f.close()
+    product_path = os.path.join(self.products_path, product_name)
+    self._start_load(read_product, (product_path, self.notes),
+                     lambda product: self._apply_product(product_name, product))
 
-      self.components = {}
-      self.testpoints = {}
 
-      for line in lines:
-        line = line.strip()
-        if line:
-          if line.startswith('['):
-            page = line[1:-1].lower()
-            #self.log(page)
-            self.components[page] = []
-            self.testpoints[page] = []
-          else:
-            refdes = line
-          # self.log(refdes)
-            data = self.testpoints if refdes.startswith('TP') else self.components
-            data[page].append(refdes)
+  @timed
+  def _apply_product(self, product_name, product):
+    if product is None:
+      log.error('%s is not a valid product folder', product_name)
+      return
 
+    self.product_name = product_name
+    self.product_model = product['model']
+    self.components = self.product_model.components
+    self.testpoints = self.product_model.testpoints
+    self.path.update(product['path'])
+    self.teststeps_path = product['teststeps_path']
 
-      #self.testpoints_path = os.path.join(self.products_path,product_name,"testpoints")
-      #self.components_path = os.path.join(self.products_path,product_name,"components")
+    # selection can use the sidecar until the document has to be walked
+    self.model.preload(product['model_file'], product['model_cache_file'], product['model_cache'])
+    self._install_view_callback()
+    if self.form.cb_notes_overlay.isChecked():
+      self._update_notes_overlay()
 
-      self.path["Testpoints"] = os.path.join(self.products_path,product_name,"testpoints")
-      self.path["Components"] = os.path.join(self.products_path,product_name,"components")
+    product_path = os.path.join(self.products_path,product_name)
+    self._start_notes_indexer(product_path)
+    self._watch_product(product_path)
 
-      # get all teststeps
-      self.teststeps_path = os.path.join(self.products_path,product_name,"teststeps")
-      test_steps = [x for x in os.listdir(self.teststeps_path) if os.path.isdir(os.path.join(self.teststeps_path,x))]
-      #self.log(test_steps)
-    else:
-      self.log('ERROR: not a valid product folder')
+    self.form.tw_components.clear()
+    self.form.tw_testpoints.clear()
 
+    # the list shown from the catalogue may be out of date, keep the chosen test
+    test_name = self.form.cb_test.currentText()
+    block_state = self.form.cb_test.blockSignals(True)
     self.form.cb_test.clear()
-    self.form.cb_test.addItems(test_steps)
+    self.form.cb_test.addItems(product['test_steps'])
+    if test_name in product['test_steps']:
+      self.form.cb_test.setCurrentText(test_name)
+    self.form.cb_test.blockSignals(block_state)
+
+    self.on_test_changed()
 
 
+  @timed
   def _load_test(self, test_name):
     self.current_selection = None
 
     # get components relevant for this test
-    self.test_folder = os.path.join(self.teststeps_path,test_name)
+    test_folder = os.path.join(self.teststeps_path,test_name)
+    self._start_load(read_test, (test_folder, self.product_model), self._apply_test)
+
 
-    teststep_config = os.path.join(self.test_folder,'teststep.ini')
-    config = configparser.ConfigParser()
-    config.read(teststep_config)
+  @timed
+  def _apply_test(self, test):
+    if test is None:
+      return
 
-    self._load_textedit_from_file( self.form.te_test_info, os.path.join(self.test_folder,'readme.txt'))
+    self.current_selection = None
+    self.test_folder = test['folder']
+    log.debug('test folder: %s', self.test_folder)
 
-    self.current_components = {}
-    self.current_testpoints = {}
-    self.log(self.test_folder)
-    for page in config['pages']:
-      if config['pages'][page] == 'all':
-        self.current_components[page] = self.components[page]
-        self.current_testpoints[page] = self.testpoints[page]
+    readme_path = os.path.join(self.test_folder, 'readme.txt')
+    self.note_versions[readme_path] = (test['readme_version'], test['readme'] or '')
+    self._set_textedit_text(self.form.te_test_info, test['readme'])
+    self._watch_selection()
+
+    self.current_components = test['components']
+    self.current_testpoints = test['testpoints']
+
+    self.refdes_index.build({'Components': self.current_components, 'Testpoints': self.current_testpoints})
+
+    # one repaint for both trees
+    self.form.setUpdatesEnabled(False)
+    try:
+      self._load_tws()
 
-    self._load_tws()
+      if self.form.le_search.text().strip() or self.form.cb_notes_only.isChecked():
+        self.on_search_changed()
+    finally:
+      self.form.setUpdatesEnabled(True)
+
+
+  def _start_load(self, func, args, apply):
+    # a newer load makes every running one stale
+    self._load_generation += 1
+    for worker in self._load_workers:
+      worker.requestInterruption()
+
+    worker = LoadWorker(self._load_generation, func, *args)
+    worker.done.connect(lambda generation, result: self._on_load_done(worker, apply, generation, result),
+                        PySide2.QtCore.Qt.QueuedConnection)
+    self._load_workers.append(worker)
+    self.form.progress_load.setVisible(True)
+    worker.start()
+
+
+  def _on_load_done(self, worker, apply, generation, result):
+    worker.wait()
+    self._load_workers.remove(worker)
+    if not self._load_workers:
+      self.form.progress_load.setVisible(False)
+
+    if generation != self._load_generation:
+      log.debug('dropping stale load')
+      return
+
+    if isinstance(result, Exception):
+      log.error('load failed: %s', result)
+      self._msg_box('Load failed', str(result))
+      return
+
+    apply(result)
 
 
   def _clear_product(self):
@@ -563,6 +1799,7 @@ class FreeCADtest:
 
       self.form.pb_open_folder.setEnabled(True)
       self.form.pb_add_pictures.setEnabled(True)
+      self._watch_selection()
 
       # enable add picture only when folder exsist
       #if os.path.isdir(self.current_folder):
@@ -586,18 +1823,23 @@ class FreeCADtest:
         [
           self.form.te_comp_tp_info,
           self.form.te_picture_info,
-          self.form.picture
+          self.form.picture,
+          self.form.lw_thumbnails
         ]
       )
 
       self.pictures = []
+      self._wanted_picture = None
+      self.picture_loader.drop_prefetch()
       self.current_folder = None
       self.current_selection = None
+      self._watch_selection()
 
       self.form.pb_open_folder.setEnabled(False)
       self.form.pb_add_pictures.setEnabled(False)
       self.form.pb_next.setEnabled(False)
       self.form.pb_prev.setEnabled(False)
+      self.form.pb_full_size.setEnabled(False)
       self.form.pb_open_folder.setEnabled(False)
       self.form.pb_add_pictures.setEnabled(False)
 
@@ -610,29 +1852,12 @@ class FreeCADtest:
 
 
   def _make_test_folder(self, product_name, test_name):
-    new_test_folder = os.path.join(self.teststeps_path,test_name)
-
-    os.makedirs(new_test_folder)
-
     inc = 'all' if self.form.cb_inc_all.isChecked() else 'none'
-
-    readme_file_path = os.path.join(new_test_folder,"readme.txt")
-    with open(readme_file_path, "w") as f:
-      f.write('%s components per pages included'%inc)
-    
     pages = self._get_schematic_pages(product_name)
-    config = configparser.ConfigParser()
-    config['pages'] = {}.fromkeys(pages, inc)
-
-    config_file = os.path.join(new_test_folder,"teststep.ini")
-    with open(config_file, 'w') as config_file:
-      config.write(config_file)
+    make_test_folder(self.teststeps_path, test_name, pages, inc)
 
   def _make_info_folder(self, folder):
-    # Make new folder and an empty readme file
-    os.makedirs(folder)
-    readme_file_path = os.path.join(folder,"readme.txt")
-    with open(readme_file_path, "w") as f:pass
+    make_info_folder(folder)
 
   def _open_folder(self, folder):
       os.startfile(folder)
@@ -651,13 +1876,18 @@ class FreeCADtest:
       # .setSelected(bool select)
       #
 
-      #self.log('check info: %d %s'%(self._has_info(),item_note))
-      if self._has_info() and item_note != 'YES':
-        self.log('updating info column')
+      has_info = self._has_info()
+      if has_info and item_note != 'YES':
+        log.debug('updating info column')
         current_item.setText(1, 'YES')
-      elif not self._has_info() and item_note == 'YES':
-        self.log('updating info column')
+        self._notes_state_changed(self.current_selection[1], True)
+      elif not has_info and item_note == 'YES':
+        log.debug('updating info column')
         current_item.setText(1, '')
+        self._notes_state_changed(self.current_selection[1], False)
+
+      group, refdes = self.current_selection[:2]
+      self.notes.set_notes(self.path[group], refdes, has_info)
       
 
   def _load_tws(self):
@@ -680,14 +1910,31 @@ class FreeCADtest:
       path = self.path[group]
 
       notes_path = os.path.join(path,refdes)
+      # thumbnails and neighbours of the previous selection are not needed anymore
+      self.picture_loader.drop_prefetch()
       self.pictures = []
-      for file_types in ['*.png','*.jpg']:
-        self.pictures.extend([(ppath, path, item) for ppath in glob.glob('%s/%s'%(notes_path, file_types))])
+      self.pictures = [(ppath, path, item) for ppath in list_pictures(notes_path)]
       if len(self.pictures) == 0:
         self.form.pb_prev.setEnabled(False)
         self.form.pb_next.setEnabled(False)
+      self.form.pb_full_size.setEnabled(len(self.pictures) > 0)
 
       self.picture_index = -1
+      self._set_thumbnail_strip()
+
+  def _set_thumbnail_strip(self):
+      strip = self.form.lw_thumbnails
+      strip.clear()
+      for (picture_path, path, item) in self.pictures:
+        thumb_item = PySide2.QtWidgets.QListWidgetItem(os.path.basename(picture_path))
+        thumb_item.setData(PySide2.QtCore.Qt.UserRole, picture_path)
+        strip.addItem(thumb_item)
+
+        pixmap = self.pixmap_cache.get((picture_path, THUMBNAIL_STRIP_HEIGHT))
+        if pixmap is not None:
+          thumb_item.setIcon(PySide2.QtGui.QIcon(pixmap))
+        else:
+          self.picture_loader.request(picture_path, THUMBNAIL_STRIP_HEIGHT, urgent=False)
 
 
   def _update_text_edit(self, widget, item, filename, force_enable=False):
@@ -700,24 +1947,27 @@ class FreeCADtest:
       group = self.form.tw_comm.tabText(i)
       path = self.path[group]
 
-      if item_note == 'YES':
-        self.log('notes found for %s'%refdes)
-        notes_path = os.path.join(path,refdes)
-        txt_file_path = os.path.join(notes_path,filename)
+      notes_path = os.path.join(path,refdes)
+      txt_file_path = os.path.join(notes_path,filename)
+
+      if item_note == 'YES' or self.note_saver.pending_text(txt_file_path) is not None:
+        log.debug('notes found for %s', refdes)
         self._load_textedit_from_file(widget, txt_file_path, force_enable=force_enable)
 
       else:
-        self.log('no notes found for %s'%refdes)
+        log.debug('no notes found for %s', refdes)
         widget.clear()
         widget.setEnabled(True if force_enable else False)
       widget.blockSignals(block_state)
 
 
+  @timed
   def _next_picture(self, direction=1):
     picture_widget = self.form.picture
     txt_widget = self.form.te_picture_info
 
     block_state = txt_widget.blockSignals(True)
+    self._wanted_picture = None
     picture_widget.clear()
     txt_widget.clear()
     txt_widget.setEnabled(False)
@@ -740,23 +1990,19 @@ class FreeCADtest:
     else:
        self.form.pb_next.setEnabled(True)
 
-    #self.log(self.picture_index)
-    #self.log(self.pictures)
 
     if len(self.pictures):
       picture_path = self.pictures[self.picture_index][0]
 
 
-      #picture_widget.setPixmap(PySide2.QtGui.QPixmap(os.path.realpath(picture_path)))
-      pixmap =  PySide2.QtGui.QPixmap(picture_path)
-      picture_widget.setPixmap(pixmap.scaledToHeight(self.form.picture.height()))
+      height = self.form.picture.height()
+      self._show_picture(picture_path, height)
+      self._prefetch_pictures(height)
 
       
       txt_path = os.path.splitext(picture_path)[0] + '.txt'
-      txt_folder = os.path.dirname(picture_path)
       item = self.pictures[self.picture_index][2]
-      self.log(txt_folder)
-      self.log(os.path.basename(txt_path))
+      log.debug('picture note: %s', txt_path)
 
       i = self.form.tw_comm.currentIndex()
       group = self.form.tw_comm.tabText(i)
@@ -764,33 +2010,97 @@ class FreeCADtest:
       self._update_text_edit(txt_widget, item, os.path.basename(txt_path), force_enable=True)
 
 
+  def _show_picture(self, picture_path, height):
+    pixmap = self.pixmap_cache.get((picture_path, height))
+    if pixmap is not None:
+      self.form.picture.setPixmap(pixmap)
+    else:
+      # shown by _on_picture_loaded once the worker is done
+      self._wanted_picture = (picture_path, height)
+      self.picture_loader.request(picture_path, height)
+
+  def _prefetch_pictures(self, height):
+    for index in (self.picture_index + 1, self.picture_index - 1):
+      if 0 <= index < len(self.pictures):
+        picture_path = self.pictures[index][0]
+        if self.pixmap_cache.get((picture_path, height)) is None:
+          self.picture_loader.request(picture_path, height, urgent=False)
+
+  def _on_picture_loaded(self, picture_path, height, image):
+    if image.isNull():
+      log.warning('could not load %s', picture_path)
+      return
+
+    pixmap = QPixmap.fromImage(image)
+    self.pixmap_cache.put((picture_path, height), pixmap)
+
+    if height == THUMBNAIL_STRIP_HEIGHT:
+      strip = self.form.lw_thumbnails
+      for row in range(strip.count()):
+        thumb_item = strip.item(row)
+        if thumb_item.data(PySide2.QtCore.Qt.UserRole) == picture_path:
+          thumb_item.setIcon(PySide2.QtGui.QIcon(pixmap))
+
+    if self._wanted_picture == (picture_path, height):
+      self._wanted_picture = None
+      self.form.picture.setPixmap(pixmap)
+
+
+  @timed
   def _load_tw(self, widget, data, path):
     widget.clear()
     items = []
 
+    # pages are inserted collapsed, children are made by _populate_page
     for key, values in data.items():
         item = QTreeWidgetItem([key])
-        for refdes in sorted(values):
-            notes_path = os.path.join(path,refdes)
-            
-            note = 'YES' if os.path.isdir(notes_path) else ''
-            child = QTreeWidgetItem([refdes, note])
-            item.addChild(child)
+        if values:
+          item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
         items.append(item)
     widget.insertTopLevelItems(0, items)
 
 
+  def _tw_group(self, widget):
+    return 'Components' if widget is self.form.tw_components else 'Testpoints'
+
+  def _tw_source(self, widget):
+    if widget is self.form.tw_components:
+      return self.current_components, self.path['Components']
+    return self.current_testpoints, self.path['Testpoints']
+
+
+  @timed
+  def _populate_page(self, item):
+    # create the refdes items of a page the first time it is needed
+    if item.data(0, PySide2.QtCore.Qt.UserRole):
+      return
+    item.setData(0, PySide2.QtCore.Qt.UserRole, True)
+
+    data, path = self._tw_source(item.treeWidget())
+    notes = self.notes.notes(path)
+
+    children = [QTreeWidgetItem(row) for row in page_rows(data.get(item.text(0), []), notes)]
+    item.addChildren(children)
+    item.setChildIndicatorPolicy(QTreeWidgetItem.DontShowIndicatorWhenChildless)
+
+
   def _load_textedit_from_file(self, widget, path, force_enable=False):
+    log.debug('load note %s', path)
+    # a note still queued for saving is newer than the file
+    text = self.note_saver.pending_text(path)
+    if text is None:
+      text, version = read_versioned(path)
+      self.note_versions[path] = (version, text or '')
+    self._set_textedit_text(widget, text, force_enable=force_enable)
+
+
+  def _set_textedit_text(self, widget, text, force_enable=False):
+    # text is None when the file does not exist
     block_state = widget.blockSignals(True)
-    self.log('force enable: %d'%force_enable)
-    self.log(path)
-    if os.path.isfile(path):
+    log.debug('force enable: %d', force_enable)
+    if text is not None:
       widget.setEnabled(True)
-      with open(path) as f:
-        text = ''
-        for line in f.readlines():
-          text += line
-        widget.setPlainText(text)
+      widget.setPlainText(text)
     else:
       widget.clear()
       widget.setEnabled(True if force_enable else False)
@@ -799,23 +2109,8 @@ class FreeCADtest:
 
 
   def _get_schematic_pages(self, product_name):
-    # get components per page
     prodfile = os.path.join(self.products_path, product_name,"components.txt")
-    f = open(prodfile)
-    lines = f.readlines()
-    f.close()
-
-    self.components = {}
-    self.testpoints = {}
-
-    pages = []
-    for line in lines:
-      line = line.strip()
-      if line:
-        if line.startswith('['):
-          page = line[1:-1].lower()
-          pages.append(page)
-    return pages
+    return load_product_model(prodfile).pages
 
   
   def _msg_box(self, title, text):
@@ -837,32 +2132,16 @@ class FreeCADtest:
 
 
   def _save_to_file_and_backup(self, widget, file_path):
-    # https://stackoverflow.com/questions/25851314/making-a-backup-file-appending-date-time-moving-file-if-the-file-exists-pyt
-    # rename origianl file
-    filename = Path(os.path.basename(file_path))
-    self.log(filename)
-
-    target_directory = os.path.join(os.path.dirname(file_path),'bakcup')
-    if not os.path.isdir(target_directory):
-      os.makedirs(target_directory)
-    target_directory = Path(target_directory)
-    self.log(target_directory)
-    
-    # if file does not exsist, skip making backup
-    if os.path.isfile(file_path):
-      modified_time = os.path.getmtime(file_path)
-      timestamp = datetime.fromtimestamp(modified_time).strftime("%b-%d-%Y_%H.%M.%S")
-      target_file = target_directory / f'{filename.stem}_{timestamp}{filename.suffix}'
-      #self.log(target_file)
-      os.rename(file_path, target_file)
-
-    # wire new file
-    new_text = widget.toPlainText()
-    self.log(new_text)
-    with open(file_path, "w") as f:
-      f.write(new_text)
-
-  def _is_dirty(self):
-    return self._test_info_dirty or  self._comp_tp_info_dirty or self._picture_info_dirty
+    log.debug('save %s', file_path)
+    self.note_saver.enqueue(file_path, widget.toPlainText(), self.note_versions.get(file_path))
+
+  def _backup_policy(self):
+    # retention of note revisions, see BackupStore
+    pack = self.settings.value("backup_pack", 'true') in (True, 'true')
+    return {
+      'keep': int(self.settings.value("backup_keep", BACKUP_KEEP)),
+      'max_age_days': int(self.settings.value("backup_max_age_days", BACKUP_MAX_AGE_DAYS)),
+      'pack_after': BACKUP_PACK_AFTER if pack else None,
+    }
 
 Gui.Control.showDialog(FreeCADtest())
\ No newline at end of file
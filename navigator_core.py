@@ -0,0 +1,1504 @@
+# GUI-free part of the PCB navigator.
+#
+# Everything here works on plain paths and Python objects so it can be used
+# and measured outside FreeCAD; navigator.py adapts it to the Qt widgets.
+
+import os
+import sys
+import configparser
+import json
+import math
+import threading
+import re
+import fnmatch
+import logging
+import time
+import functools
+from contextlib import contextmanager
+# sqlite3, hashlib, shutil, gzip, difflib, html, base64, zipfile and
+# xml.etree are imported where used, nothing needs them at startup
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+log = logging.getLogger('pcb_navigator')
+
+
+class Profile:
+  # wall time of named spans, summed over the session. Spans are logged
+  # at debug level; report() and dump() show where the time went
+  def __init__(self):
+    self.spans = {} # name -> [calls, total seconds, longest seconds]
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def span(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        stats = self.spans.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+      log.debug('%s: %.1f ms', name, elapsed*1000)
+
+  def timed(self, func):
+    # decorator, one span per call named after the function
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with self.span(func.__name__):
+        return func(*args, **kwargs)
+    return wrapper
+
+  def report(self):
+    with self._lock:
+      spans = sorted(self.spans.items(), key=lambda span: span[1][1], reverse=True)
+    lines = ['%-24s %8s %10s %10s %10s'%('span', 'calls', 'total ms', 'mean ms', 'max ms')]
+    for name, (calls, total, longest) in spans:
+      lines.append('%-24s %8d %10.1f %10.2f %10.2f'%(name, calls, total*1000, total*1000/calls, longest*1000))
+    return '\n'.join(lines)
+
+  def dump(self, path):
+    with self._lock:
+      spans = {name: {'calls': calls, 'total_s': total, 'max_s': longest}
+               for name, (calls, total, longest) in self.spans.items()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      json.dump(spans, f, indent=1)
+
+
+profile = Profile()
+timed = profile.timed
+
+
+# full-text index of a product's notes, stored in the product folder
+NOTES_INDEX_FILE = '.notes_index.sqlite'
+
+# local catalogue of all products under a products_path
+CATALOGUE_FILE = 'catalogue.sqlite'
+
+# sidecar with the refdes/layer/bbox mapping of step/pcb.FCStd
+MODEL_FILE = os.path.join('step', 'pcb.FCStd')
+MODEL_CACHE_FILE = os.path.join('step', '.pcb_model_cache.json')
+MODEL_CACHE_VERSION = 3
+
+# picture file types shown for a refdes
+PICTURE_TYPES = ('.png', '.jpg')
+
+# display-sized copies of imported pictures, next to the originals
+DISPLAY_FOLDER = 'display'
+
+# note revisions, see BackupStore
+BACKUP_FOLDER = 'bakcup'
+BACKUP_KEEP = 20
+BACKUP_MAX_AGE_DAYS = 0 # 0: no age limit
+BACKUP_PACK_AFTER = 5
+
+
+class ModelIndex:
+  # refdes -> (object, layer, bounding box centre) for a FreeCAD document.
+  # Built once per document and dropped only when the document changes or
+  # the observer reports objects added or removed.
+  #
+  # records holds refdes -> (layer, centre, origin, object name, label,
+  # (xmin, ymin, xmax, ymax, zmin, zmax)) without document objects; it is
+  # what the model sidecar cache stores and lets the index be preloaded
+  # before the document is walked.
+  def __init__(self):
+    self.doc_name = None
+    self.symbols = {}
+    self.records = {}
+    self.labels = {}
+    self.valid = False
+    self.labels_valid = False
+
+    self.model_file = None
+    self.cache_file = None
+    self.preloaded = False
+    self.lazy = False
+
+  def invalidate(self, objects_changed=False):
+    self.valid = False
+    self.labels_valid = False
+    if objects_changed:
+      # the document no longer matches what the sidecar describes
+      self.preloaded = False
+
+  def invalidate_labels(self):
+    self.labels_valid = False
+
+  def _check_document(self, doc):
+    if doc.Name != self.doc_name:
+      self.doc_name = doc.Name
+      self.valid = False
+      self.labels_valid = False
+
+  def preload(self, model_file, cache_file, records):
+    # records from load_model_cache(), or None when there is no valid sidecar
+    self.model_file = model_file
+    self.cache_file = cache_file
+    self.preloaded = records is not None
+    if records is not None:
+      self.records = records
+    self.valid = False
+
+  def _is_model_file(self, doc):
+    file_name = getattr(doc, 'FileName', '')
+    return bool(self.model_file and file_name) and \
+      os.path.normcase(os.path.abspath(file_name)) == os.path.normcase(os.path.abspath(self.model_file))
+
+  def ensure(self, doc):
+    # make records and symbols valid for doc, from the sidecar if possible
+    self._check_document(doc)
+    if not self.valid:
+      if self.preloaded and self._is_model_file(doc):
+        # objects are looked up by name when first selected
+        self.symbols = {}
+        self.lazy = True
+        self.valid = True
+      else:
+        self.build(doc)
+
+  def get(self, doc, refdes):
+    if doc is None:
+      raise KeyError(refdes)
+
+    self.ensure(doc)
+
+    if self.lazy and refdes not in self.symbols:
+      layer, center, origin, name, label, bbox = self.records[refdes]
+      obj = doc.getObject(name)
+      if obj is None:
+        # sidecar out of step with the document, walk it after all
+        self.preloaded = False
+        self.build(doc)
+      else:
+        self.symbols[refdes] = (obj, layer, center)
+
+    return self.symbols[refdes]
+
+  def by_label(self, doc, label):
+    # label -> object over all document objects, reused across calls
+    if doc is None:
+      return None
+
+    self._check_document(doc)
+    if not self.labels_valid:
+      self.labels = {}
+      for obj in doc.Objects:
+        # first object wins, same as the old linear scan
+        self.labels.setdefault(obj.Label, obj)
+      self.labels_valid = True
+
+    return self.labels.get(label)
+
+  def _add(self, refdes, obj, layer, origin):
+    box = obj.Shape.BoundBox
+    center = box.Center
+    self.symbols[refdes] = (obj, layer, center)
+    self.records[refdes] = (layer, (center.x, center.y, center.z), origin, obj.Name, obj.Label,
+                            (box.XMin, box.YMin, box.XMax, box.YMax, box.ZMin, box.ZMax))
+
+  def build(self, doc):
+    self.doc_name = doc.Name
+    self.symbols = {}
+    self.records = {}
+    self.lazy = False
+
+    components = doc.getObject('Components')
+    placebounds = doc.getObject('PlaceBound')
+
+    layers = ['Top', 'Bottom']
+
+    for layer in layers:
+      comps = components.getObject('Components%s'%layer)
+      for name in comps.getSubObjects():
+        obj_name = name.strip('.')
+        obj = comps.getObject(obj_name)
+
+        refdes = obj_name
+        self._add(refdes, obj, layer, 'Components')
+
+      if placebounds is None:
+        continue
+      placebound = placebounds.getObject('PlaceBound%s'%layer)
+      if placebound == None:
+        continue
+      for feaure_name in placebound.getSubObjects():
+        obj = placebound.getObject(feaure_name.strip('.'))
+        refdes = obj.Label[obj.Label.index('_')+1:]
+
+        self._add(refdes, obj, layer, 'PlaceBound')
+
+    self.valid = True
+
+    if self.cache_file and self._is_model_file(doc):
+      try:
+        save_model_cache(self.cache_file, self.model_file, self.records)
+      except OSError:
+        pass # read-only share, the cache is an optimisation only
+
+
+def model_cache_key(model_file):
+  # mtime and size of the model files the sidecar was made from
+  key = []
+  for path in (model_file, os.path.splitext(model_file)[0] + '.stp'):
+    try:
+      stat = os.stat(path)
+      key.append([os.path.basename(path), stat.st_mtime_ns, stat.st_size])
+    except OSError:
+      pass
+  return key
+
+
+def load_model_cache(cache_file, model_file):
+  # ModelIndex records from the sidecar, None if missing or out of date
+  try:
+    with open(cache_file) as f:
+      data = json.load(f)
+  except (OSError, ValueError):
+    return None
+
+  if data.get('version') != MODEL_CACHE_VERSION or data.get('key') != model_cache_key(model_file):
+    return None
+
+  return {refdes: (layer, tuple(center), origin, name, label, tuple(bbox))
+          for refdes, layer, center, origin, name, label, bbox in data['records']}
+
+
+def save_model_cache(cache_file, model_file, records):
+  data = {
+    'version': MODEL_CACHE_VERSION,
+    'key': model_cache_key(model_file),
+    'records': [[refdes, layer, list(center), origin, name, label, list(bbox)]
+                for refdes, (layer, center, origin, name, label, bbox) in records.items()],
+  }
+  tmp_file = cache_file + '.tmp'
+  with open(tmp_file, 'w') as f:
+    json.dump(data, f, separators=(',', ':'))
+  os.replace(tmp_file, cache_file)
+
+
+class SpatialIndex:
+  # uniform grid over the xy bounding boxes of the parts on one board layer,
+  # for point (nearest) and rectangle queries
+  def __init__(self, items):
+    # items: [(refdes, (xmin, ymin, xmax, ymax))]
+    self.boxes = dict(items)
+    self.cells = {}
+
+    if not self.boxes:
+      self.cell_size = 1.0
+      return
+
+    # about one part per cell on average, never below the median part size
+    xmin = min(box[0] for box in self.boxes.values())
+    ymin = min(box[1] for box in self.boxes.values())
+    xmax = max(box[2] for box in self.boxes.values())
+    ymax = max(box[3] for box in self.boxes.values())
+    area = max((xmax - xmin) * (ymax - ymin), 1e-6)
+    sizes = sorted(max(box[2] - box[0], box[3] - box[1]) for box in self.boxes.values())
+    self.cell_size = max((area / len(self.boxes)) ** 0.5, sizes[len(sizes) // 2], 1e-3)
+
+    for refdes, box in self.boxes.items():
+      for cell in self._cells(*box):
+        self.cells.setdefault(cell, []).append(refdes)
+    self.cell_range = self._cell(xmin, ymin) + self._cell(xmax, ymax)
+
+  def _cell(self, x, y):
+    return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+  def _cells(self, xmin, ymin, xmax, ymax):
+    x0, y0 = self._cell(xmin, ymin)
+    x1, y1 = self._cell(xmax, ymax)
+    for ix in range(x0, x1 + 1):
+      for iy in range(y0, y1 + 1):
+        yield ix, iy
+
+  def query_rect(self, xmin, ymin, xmax, ymax):
+    # refdes whose bounding box overlaps the rectangle
+    xmin, xmax = min(xmin, xmax), max(xmin, xmax)
+    ymin, ymax = min(ymin, ymax), max(ymin, ymax)
+    found = set()
+    if not self.boxes:
+      return found
+
+    # cells outside the grid are empty, a zoomed-out drag must not walk them
+    gx0, gy0, gx1, gy1 = self.cell_range
+    x0, y0 = self._cell(xmin, ymin)
+    x1, y1 = self._cell(xmax, ymax)
+    for ix in range(max(x0, gx0), min(x1, gx1) + 1):
+      for iy in range(max(y0, gy0), min(y1, gy1) + 1):
+        for refdes in self.cells.get((ix, iy), ()):
+          box = self.boxes[refdes]
+          if box[0] <= xmax and box[2] >= xmin and box[1] <= ymax and box[3] >= ymin:
+            found.add(refdes)
+    return found
+
+  def _ring(self, cx, cy, ring):
+    # cells at chebyshev distance ring from (cx, cy), clamped to the grid
+    x0, y0, x1, y1 = self.cell_range
+    if ring == 0:
+      yield cx, cy
+      return
+    for iy in (cy - ring, cy + ring):
+      if y0 <= iy <= y1:
+        for ix in range(max(cx - ring, x0), min(cx + ring, x1) + 1):
+          yield ix, iy
+    for ix in (cx - ring, cx + ring):
+      if x0 <= ix <= x1:
+        for iy in range(max(cy - ring + 1, y0), min(cy + ring - 1, y1) + 1):
+          yield ix, iy
+
+  def nearest(self, x, y, max_distance=None):
+    # refdes closest to (x, y), 0 distance inside a box; the smaller box
+    # wins between overlapping parts. None if nothing within max_distance
+    if not self.boxes:
+      return None
+
+    cx, cy = self._cell(x, y)
+    best = None
+    x0, y0, x1, y1 = self.cell_range
+    # rings before the grid are empty, rings after it too
+    ring = max(x0 - cx, cx - x1, y0 - cy, cy - y1, 0)
+    max_ring = max(abs(cx - x0), abs(cx - x1), abs(cy - y0), abs(cy - y1))
+    while ring <= max_ring:
+      # every cell of this ring is at least (ring - 1) * cell_size away
+      if max_distance is not None and (ring - 1) * self.cell_size > max_distance:
+        break
+      for cell in self._ring(cx, cy, ring):
+        for refdes in self.cells.get(cell, ()):
+          box = self.boxes[refdes]
+          dx = max(box[0] - x, 0, x - box[2])
+          dy = max(box[1] - y, 0, y - box[3])
+          rank = (math.hypot(dx, dy), (box[2] - box[0]) * (box[3] - box[1]))
+          if best is None or rank < best[0]:
+            best = (rank, refdes)
+      # anything in further rings is at least ring * cell_size away
+      if best is not None and best[0][0] <= ring * self.cell_size:
+        break
+      ring += 1
+
+    if best is None or (max_distance is not None and best[0][0] > max_distance):
+      return None
+    return best[1]
+
+
+def marker_position(record):
+  # (layer, point) on the outer face of a part, where its body does not hide it
+  layer, center, origin, name, label, bbox = record
+  return layer, (center[0], center[1], bbox[5] if layer == 'Top' else bbox[4])
+
+
+def board_index(records):
+  # {layer: SpatialIndex} from ModelIndex.records
+  layers = {}
+  for refdes, (layer, center, origin, name, label, bbox) in records.items():
+    layers.setdefault(layer, []).append((refdes, bbox[:4]))
+  return {layer: SpatialIndex(items) for layer, items in layers.items()}
+
+
+class NotesIndex:
+  # names of the refdes note folders under components/ and testpoints/,
+  # read with one scandir per folder and cached until the folder mtime changes
+  def __init__(self):
+    self._cache = {} # path -> (mtime, set of refdes)
+
+  def refresh(self, path):
+    try:
+      mtime = os.stat(path).st_mtime_ns
+    except OSError:
+      self._cache[path] = (None, set())
+      return
+
+    cached = self._cache.get(path)
+    if cached and cached[0] == mtime:
+      return
+
+    with os.scandir(path) as entries:
+      notes = {entry.name for entry in entries if entry.is_dir()}
+    self._cache[path] = (mtime, notes)
+
+  def notes(self, path):
+    if path not in self._cache:
+      self.refresh(path)
+    return self._cache[path][1]
+
+  def has_notes(self, path, refdes):
+    return refdes in self.notes(path)
+
+  def set_notes(self, path, refdes, state):
+    notes = self.notes(path)
+    if state:
+      notes.add(refdes)
+    else:
+      notes.discard(refdes)
+
+
+class RefdesIndex:
+  # sorted arrays of refdes and page names for prefix search with bisect
+  def __init__(self):
+    self._keys = []
+    self._entries = []
+    self._page_keys = []
+    self._pages = []
+
+  def build(self, groups):
+    # groups: {'Components': {page: [refdes]}, 'Testpoints': {...}}
+    rows = sorted((refdes.lower(), refdes, group, page)
+                  for group, data in groups.items()
+                  for page, values in data.items()
+                  for refdes in values)
+    self._keys = [row[0] for row in rows]
+    self._entries = [row[1:] for row in rows]
+
+    pages = sorted((page.lower(), group, page) for group, data in groups.items() for page in data)
+    self._page_keys = [row[0] for row in pages]
+    self._pages = [row[1:] for row in pages]
+
+  def _prefix_range(self, keys, text):
+    text = text.lower()
+    return bisect_left(keys, text), bisect_left(keys, text + '\uffff')
+
+  def search(self, text):
+    # [(refdes, group, page)] with refdes starting with text
+    lo, hi = self._prefix_range(self._keys, text)
+    return self._entries[lo:hi]
+
+  def search_pages(self, text):
+    # [(group, page)] with page name starting with text
+    lo, hi = self._prefix_range(self._page_keys, text)
+    return self._pages[lo:hi]
+
+
+class NotesSearchIndex:
+  # full-text index (SQLite FTS5) over the readme and picture notes of a
+  # product, kept next to the product and updated from file mtimes
+  def __init__(self, product_path):
+    self.product_path = product_path
+    self.db_path = os.path.join(product_path, NOTES_INDEX_FILE)
+
+  def _connect(self):
+    import sqlite3
+    db = sqlite3.connect(self.db_path, timeout=10)
+    db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER)')
+    db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS notes USING fts5(path UNINDEXED, kind UNINDEXED, name, body)')
+    return db
+
+  def _scandir(self, path):
+    try:
+      with os.scandir(path) as entries:
+        return list(entries)
+    except OSError:
+      return []
+
+  def note_files(self):
+    # (relative path, kind, refdes or test name, stat) for every note file
+    for folder, kind in (('components', 'Components'), ('testpoints', 'Testpoints')):
+      for refdes_entry in self._scandir(os.path.join(self.product_path, folder)):
+        if not refdes_entry.is_dir():
+          continue
+        for entry in self._scandir(refdes_entry.path):
+          if entry.is_file() and entry.name.lower().endswith('.txt'):
+            note_kind = kind if entry.name == 'readme.txt' else 'Picture'
+            rel_path = os.path.join(folder, refdes_entry.name, entry.name)
+            yield rel_path, note_kind, refdes_entry.name, entry.stat()
+
+    for test_entry in self._scandir(os.path.join(self.product_path, 'teststeps')):
+      readme_path = os.path.join(test_entry.path, 'readme.txt')
+      if test_entry.is_dir() and os.path.isfile(readme_path):
+        rel_path = os.path.join('teststeps', test_entry.name, 'readme.txt')
+        yield rel_path, 'Test', test_entry.name, os.stat(readme_path)
+
+  def update(self, is_cancelled=lambda: False):
+    # re-read only files whose mtime or size changed; returns files updated
+    db = self._connect()
+    try:
+      known = {path: (mtime, size) for path, mtime, size in db.execute('SELECT path, mtime, size FROM files')}
+      seen = set()
+      updated = 0
+
+      for rel_path, kind, name, stat in self.note_files():
+        if is_cancelled():
+          break
+        seen.add(rel_path)
+        if known.get(rel_path) == (stat.st_mtime_ns, stat.st_size):
+          continue
+
+        try:
+          with open(os.path.join(self.product_path, rel_path), errors='replace') as f:
+            body = f.read()
+        except OSError:
+          continue
+
+        db.execute('DELETE FROM notes WHERE path = ?', (rel_path,))
+        db.execute('INSERT INTO notes (path, kind, name, body) VALUES (?, ?, ?, ?)', (rel_path, kind, name, body))
+        db.execute('INSERT OR REPLACE INTO files (path, mtime, size) VALUES (?, ?, ?)', (rel_path, stat.st_mtime_ns, stat.st_size))
+        updated += 1
+
+      if not is_cancelled():
+        for rel_path in set(known) - seen:
+          db.execute('DELETE FROM notes WHERE path = ?', (rel_path,))
+          db.execute('DELETE FROM files WHERE path = ?', (rel_path,))
+          updated += 1
+
+      db.commit()
+      return updated
+    finally:
+      db.close()
+
+  def search(self, text, limit=200):
+    # [(relative path, kind, name, snippet)], best matches first
+    import sqlite3
+    words = text.split()
+    if not words:
+      return []
+    query = ' '.join('"%s"*'%word.replace('"', '""') for word in words)
+
+    db = self._connect()
+    try:
+      return db.execute(
+        "SELECT path, kind, name, snippet(notes, 3, '[', ']', '...', 10) FROM notes "
+        "WHERE notes MATCH ? ORDER BY bm25(notes) LIMIT ?", (query, limit)).fetchall()
+    except sqlite3.OperationalError:
+      return []
+    finally:
+      db.close()
+
+
+class ProductModel:
+  # components.txt in one pass: page -> refdes lists per group and the
+  # reverse refdes -> pages index, in file order
+  def __init__(self):
+    self.pages = []
+    self.components = {}
+    self.testpoints = {}
+    self.pages_of = {}
+    self._page_keys = {}
+
+  def page_keys(self, page):
+    # upper case refdes -> refdes on a page, built on first use
+    keys = self._page_keys.get(page)
+    if keys is None:
+      keys = {refdes.upper(): refdes for refdes in self.components.get(page, []) + self.testpoints.get(page, [])}
+      self._page_keys[page] = keys
+    return keys
+
+  @classmethod
+  def parse(cls, prodfile):
+    model = cls()
+    components = model.components
+    testpoints = model.testpoints
+    pages_of = model.pages_of
+    page = None
+
+    # stream the file, generated netlists can be large
+    with open(prodfile) as f:
+      for line in f:
+        line = line.strip()
+        if line:
+          if line.startswith('['):
+            page = sys.intern(line[1:-1].lower())
+            model.pages.append(page)
+            components[page] = []
+            testpoints[page] = []
+          elif page is not None:
+            refdes = sys.intern(line)
+            data = testpoints if refdes.startswith('TP') else components
+            data[page].append(refdes)
+            pages_of.setdefault(refdes, []).append(page)
+    return model
+
+
+_product_models = {} # prodfile -> (mtime, size, ProductModel)
+
+def load_product_model(prodfile):
+  # parsed components.txt, re-parsed only when the file changes
+  stat = os.stat(prodfile)
+  cached = _product_models.get(prodfile)
+  if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+    return cached[2]
+
+  model = ProductModel.parse(prodfile)
+  _product_models[prodfile] = (stat.st_mtime_ns, stat.st_size, model)
+  return model
+
+
+def list_pictures(notes_path):
+  # one directory listing instead of a glob per file type
+  try:
+    with os.scandir(notes_path) as entries:
+      return sorted(entry.path for entry in entries if os.path.splitext(entry.name)[1].lower() in PICTURE_TYPES)
+  except FileNotFoundError:
+    return []
+
+
+def display_copy_path(picture_path):
+  # where the display-sized copy of a picture is kept, if there is one
+  folder, name = os.path.split(picture_path)
+  return os.path.join(folder, DISPLAY_FOLDER, os.path.splitext(name)[0] + '.jpg')
+
+
+def file_digest(path):
+  import hashlib
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1024*1024), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+class PictureImport:
+  # copies pictures into a note folder from several threads. Content already
+  # in the folder is skipped, name collisions get a _N suffix, and every
+  # copied picture gets an empty .txt sidecar
+  def __init__(self, folder, make_display_copy=None):
+    self.folder = folder
+    self.make_display_copy = make_display_copy
+    self._lock = threading.Lock()
+    self._by_size = {} # size -> [picture path], only equal sizes are hashed
+    self._digests = {} # picture path -> sha1
+    self._imported = {} # sha1 -> picture path, for duplicates within one import
+    self._stems = set() # lower case stems in use, pictures share them with sidecars
+
+    with os.scandir(folder) as entries:
+      for entry in entries:
+        if not entry.is_file():
+          continue
+        self._stems.add(os.path.splitext(entry.name)[0].lower())
+        if os.path.splitext(entry.name)[1].lower() in PICTURE_TYPES:
+          self._by_size.setdefault(entry.stat().st_size, []).append(entry.path)
+
+  def _digest(self, path):
+    if path not in self._digests:
+      self._digests[path] = file_digest(path)
+    return self._digests[path]
+
+  def _free_name(self, name):
+    stem, ext = os.path.splitext(name)
+    candidate = stem
+    n = 1
+    while candidate.lower() in self._stems:
+      candidate = '%s_%d'%(stem, n)
+      n += 1
+    self._stems.add(candidate.lower())
+    return candidate + ext
+
+  def import_one(self, src_path):
+    # ('copied' | 'duplicate', picture path in the folder)
+    import shutil
+    size = os.stat(src_path).st_size
+    digest = file_digest(src_path)
+
+    with self._lock:
+      candidates = list(self._by_size.get(size, []))
+    for path in candidates:
+      if self._digest(path) == digest:
+        return 'duplicate', path
+
+    with self._lock:
+      if digest in self._imported:
+        return 'duplicate', self._imported[digest]
+      dst_name = self._free_name(os.path.basename(src_path))
+      dst_path = os.path.join(self.folder, dst_name)
+      self._imported[digest] = dst_path
+
+    # copy under a temporary name so a half copied picture is never listed
+    tmp_path = os.path.join(self.folder, '.%s.part'%dst_name)
+    shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+    # add empty picture description file
+    info_file_path = os.path.splitext(dst_path)[0] + '.txt'
+    if not os.path.exists(info_file_path):
+      with open(info_file_path, "w") as f:pass
+
+    with self._lock:
+      self._by_size.setdefault(size, []).append(dst_path)
+      self._digests[dst_path] = digest
+
+    if self.make_display_copy:
+      os.makedirs(os.path.join(self.folder, DISPLAY_FOLDER), exist_ok=True)
+      self.make_display_copy(dst_path, display_copy_path(dst_path))
+
+    return 'copied', dst_path
+
+
+def page_rows(refdes_list, notes):
+  # (refdes, notes column) rows of one tree page
+  return [(refdes, 'YES' if refdes in notes else '') for refdes in sorted(refdes_list)]
+
+
+def make_test_folder(teststeps_path, test_name, pages, inc):
+  new_test_folder = os.path.join(teststeps_path,test_name)
+
+  os.makedirs(new_test_folder)
+
+  readme_file_path = os.path.join(new_test_folder,"readme.txt")
+  with open(readme_file_path, "w") as f:
+    f.write('%s components per pages included'%inc)
+
+  config = configparser.ConfigParser()
+  config['pages'] = {}.fromkeys(pages, inc)
+
+  config_file = os.path.join(new_test_folder,"teststep.ini")
+  with open(config_file, 'w') as config_file:
+    config.write(config_file)
+  return new_test_folder
+
+
+def make_info_folder(folder):
+  # Make new folder and an empty readme file
+  os.makedirs(folder)
+  readme_file_path = os.path.join(folder,"readme.txt")
+  with open(readme_file_path, "w") as f:pass
+
+
+def write_atomic(file_path, text):
+  # write next to the target and swap it in, so a crash or a dropped
+  # connection leaves either the old or the new file, never half of one
+  folder, file_name = os.path.split(file_path)
+  tmp_path = os.path.join(folder, '.%s.%d.tmp'%(file_name, threading.get_ident()))
+  try:
+    with open(tmp_path, "w") as f:
+      f.write(text)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+
+class BackupStore:
+  # revisions of the note files in one folder, kept in its bakcup/ folder.
+  # bakcup/index.json lists every revision, so history is read without
+  # scanning the folder; equal content is stored once, old revisions are
+  # dropped by count and age and optionally gzip packed
+  INDEX_FILE = 'index.json'
+  # <stem>_<timestamp><suffix> copies made before the index existed
+  LEGACY_BLOB = re.compile(r'^(?P<stem>.+)_(?P<time>[A-Za-z]{3}-\d{2}-\d{4}_\d{2}\.\d{2}\.\d{2})(?P<suffix>\.[^.]*)$')
+
+  def __init__(self, folder, keep=BACKUP_KEEP, max_age_days=BACKUP_MAX_AGE_DAYS, pack_after=BACKUP_PACK_AFTER):
+    self.folder = folder
+    self.backup_folder = os.path.join(folder, BACKUP_FOLDER)
+    self.keep = keep
+    self.max_age_days = max_age_days
+    self.pack_after = pack_after # None: never pack
+
+  def _index_path(self):
+    return os.path.join(self.backup_folder, self.INDEX_FILE)
+
+  def _read_index(self):
+    # {'files': {file name: [revision]}, 'legacy_imported': bool}
+    try:
+      with open(self._index_path()) as f:
+        index = json.load(f)
+    except (OSError, ValueError):
+      index = {}
+    if 'files' not in index:
+      index = {'files': index} # first layout, file names at the top
+
+    if not index.get('legacy_imported'):
+      # the folder is scanned once, later reads trust the index
+      index['legacy_imported'] = True
+      if os.path.isdir(self.backup_folder):
+        self._import_legacy(index['files'])
+        self._write_index(index)
+    return index
+
+  def _import_legacy(self, files):
+    # add backups from before index.json, so retention and history cover them too
+    with os.scandir(self.backup_folder) as entries:
+      names = [entry.name for entry in entries if entry.is_file()]
+
+    used = {revision['blob'] for revisions in files.values() for revision in revisions}
+    imported = set()
+    for blob in names:
+      match = self.LEGACY_BLOB.match(blob)
+      if blob in used or match is None:
+        continue
+      blob_path = os.path.join(self.backup_folder, blob)
+      try:
+        modified_time = datetime.strptime(match.group('time'), "%b-%d-%Y_%H.%M.%S").timestamp()
+      except ValueError:
+        modified_time = os.path.getmtime(blob_path)
+
+      file_name = match.group('stem') + match.group('suffix')
+      revisions = files.setdefault(file_name, [])
+      digest = file_digest(blob_path)
+      same = next((revision['blob'] for revision in revisions if revision['sha1'] == digest), None)
+      if same is not None:
+        os.remove(blob_path) # equal content is stored once
+        blob = same
+      revisions.append({'time': modified_time, 'sha1': digest, 'blob': blob})
+      imported.add(file_name)
+
+    for file_name in imported:
+      files[file_name].sort(key=lambda revision: revision['time'])
+      self._apply_policy(files, file_name)
+
+  def _write_index(self, index):
+    tmp_path = self._index_path() + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(index, f, indent=1)
+    os.replace(tmp_path, self._index_path())
+
+  def history(self, file_name):
+    # revisions of file_name, newest first:
+    # [{'time': epoch seconds, 'sha1': ..., 'blob': file in bakcup/}]
+    return list(reversed(self._read_index()['files'].get(file_name, [])))
+
+  def read_revision(self, revision):
+    import gzip
+    blob_path = os.path.join(self.backup_folder, revision['blob'])
+    if blob_path.endswith('.gz'):
+      with gzip.open(blob_path, 'rt') as f:
+        return f.read()
+    with open(blob_path) as f:
+      return f.read()
+
+  def restore(self, file_name, revision):
+    # put a revision back as the current file, keeping the current one
+    return self.save(file_name, self.read_revision(revision))
+
+  def save(self, file_name, new_text):
+    # write new_text to file_name, backing up the current content first.
+    # Returns False when the content is unchanged and nothing was written
+    file_path = os.path.join(self.folder, file_name)
+    old_text = read_text(file_path)
+    if old_text == new_text:
+      return False
+
+    if old_text is not None:
+      self.add_revision(file_name)
+
+    os.makedirs(self.folder, exist_ok=True)
+    write_atomic(file_path, new_text)
+    return True
+
+  def add_revision(self, file_name):
+    # record the current content of file_name as a revision
+    import shutil
+    file_path = os.path.join(self.folder, file_name)
+    os.makedirs(self.backup_folder, exist_ok=True)
+    index = self._read_index()
+    files = index['files']
+    revisions = files.setdefault(file_name, [])
+
+    digest = file_digest(file_path)
+    if revisions and revisions[-1]['sha1'] == digest:
+      return # unchanged since the last revision
+
+    modified_time = os.path.getmtime(file_path)
+    blob = next((revision['blob'] for revision in revisions if revision['sha1'] == digest), None)
+    if blob is None:
+      stem, suffix = os.path.splitext(file_name)
+      timestamp = datetime.fromtimestamp(modified_time).strftime("%b-%d-%Y_%H.%M.%S")
+      blob = '%s_%s_%s%s'%(stem, timestamp, digest[:8], suffix)
+      shutil.copyfile(file_path, os.path.join(self.backup_folder, blob))
+
+    revisions.append({'time': modified_time, 'sha1': digest, 'blob': blob})
+    self._apply_policy(files, file_name)
+    self._write_index(index)
+
+  def _apply_policy(self, files, file_name):
+    revisions = files[file_name]
+
+    kept = revisions[-self.keep:] if self.keep else revisions
+    if self.max_age_days:
+      oldest = datetime.now().timestamp() - self.max_age_days * 86400
+      kept = [revision for revision in kept if revision['time'] >= oldest] or kept[-1:]
+    files[file_name] = kept
+
+    # pack everything but the newest revisions; their content may share a
+    # blob with older revisions, which then stays (or becomes) unpacked
+    if self.pack_after is not None:
+      newest = kept[-self.pack_after:] if self.pack_after else []
+      fresh = {revision['sha1'] for revision in newest}
+      for revision in newest:
+        if revision['blob'].endswith('.gz'):
+          self._unpack(kept, revision['blob'])
+      for revision in kept[:-self.pack_after or None]:
+        if revision['sha1'] not in fresh and not revision['blob'].endswith('.gz'):
+          self._pack(kept, revision['blob'])
+
+    # remove blobs nothing refers to anymore
+    used = {revision['blob'] for revisions in files.values() for revision in revisions}
+    for revision in revisions:
+      if revision['blob'] not in used:
+        try:
+          os.remove(os.path.join(self.backup_folder, revision['blob']))
+        except OSError:
+          pass
+
+  def _pack(self, revisions, blob):
+    import gzip
+    import shutil
+    blob_path = os.path.join(self.backup_folder, blob)
+    with open(blob_path, 'rb') as src, gzip.open(blob_path + '.gz', 'wb') as dst:
+      shutil.copyfileobj(src, dst)
+    for revision in revisions:
+      if revision['blob'] == blob:
+        revision['blob'] = blob + '.gz'
+    os.remove(blob_path)
+
+  def _unpack(self, revisions, blob):
+    import gzip
+    import shutil
+    blob_path = os.path.join(self.backup_folder, blob)
+    with gzip.open(blob_path, 'rb') as src, open(blob_path[:-3], 'wb') as dst:
+      shutil.copyfileobj(src, dst)
+    for revision in revisions:
+      if revision['blob'] == blob:
+        revision['blob'] = blob[:-3]
+    os.remove(blob_path)
+
+
+def save_with_backup(file_path, new_text, **policy):
+  # save a note, keeping the previous content in the folder's BackupStore
+  folder, file_name = os.path.split(file_path)
+  return BackupStore(folder, **policy).save(file_name, new_text)
+
+
+def read_text(path):
+  # file content, or None when there is no such file
+  if not os.path.isfile(path):
+    return None
+  with open(path) as f:
+    return f.read()
+
+
+def file_version(path):
+  # cheap version stamp of a note: (mtime_ns, size), None when missing.
+  # A save only goes through if the file still has the stamp the edit
+  # started from, so concurrent edits on the share are detected, not lost
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
+
+
+def read_versioned(path):
+  # (text, version) of a note; stamped before reading, so a change in
+  # between shows up as a conflict instead of being missed
+  version = file_version(path)
+  return read_text(path), version
+
+
+def merge3(base, mine, theirs):
+  # line based three-way merge. Returns (text, conflicts); overlapping
+  # changes are kept both, between <<<<<<< mine / ======= / >>>>>>> theirs
+  import difflib
+  if mine == theirs or theirs == base:
+    return mine, False
+  if mine == base:
+    return theirs, False
+
+  base_lines = base.splitlines(keepends=True)
+  sides = (mine.splitlines(keepends=True), theirs.splitlines(keepends=True))
+
+  # (base start, base end, side, replacement lines), by position in base
+  hunks = []
+  for side, lines in enumerate(sides):
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+      if tag != 'equal':
+        hunks.append((i1, i2, side, lines[j1:j2]))
+  hunks.sort(key=lambda hunk: (hunk[0], hunk[1]))
+
+  def apply(side_hunks, start, end):
+    lines, pos = [], start
+    for i1, i2, side, replacement in side_hunks:
+      lines += base_lines[pos:i1] + replacement
+      pos = i2
+    return lines + base_lines[pos:end]
+
+  def terminated(lines):
+    if lines and not lines[-1].endswith('\n'):
+      return lines[:-1] + [lines[-1] + '\n']
+    return lines
+
+  merged, conflicts, pos, i = [], False, 0, 0
+  while i < len(hunks):
+    # hunks touching each other form one region
+    start, end = hunks[i][0], hunks[i][1]
+    region = [hunks[i]]
+    i += 1
+    while i < len(hunks) and hunks[i][0] <= end:
+      end = max(end, hunks[i][1])
+      region.append(hunks[i])
+      i += 1
+
+    merged += base_lines[pos:start]
+    pieces = [apply([hunk for hunk in region if hunk[2] == side], start, end) for side in (0, 1)]
+    if len({hunk[2] for hunk in region}) == 1:
+      merged += pieces[region[0][2]]
+    elif pieces[0] == pieces[1]:
+      merged += pieces[0]
+    else:
+      conflicts = True
+      merged += ['<<<<<<< mine\n'] + terminated(pieces[0]) + ['=======\n'] + terminated(pieces[1]) + ['>>>>>>> theirs\n']
+    pos = end
+
+  merged += base_lines[pos:]
+  return ''.join(merged), conflicts
+
+
+def read_model_refdes(model_file):
+  # refdes in a FreeCAD model without FreeCAD: the Components* groups and
+  # PlaceBound* labels are read from Document.xml inside the FCStd zip,
+  # the same objects ModelIndex.build walks
+  import zipfile
+  import xml.etree.ElementTree as ElementTree
+  groups = {}
+  labels = {}
+  with zipfile.ZipFile(model_file) as archive, archive.open('Document.xml') as f:
+    name = None
+    for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+      if event == 'start':
+        if element.tag == 'Object' and element.get('name'):
+          name = element.get('name')
+        continue
+      if element.tag == 'Property' and name is not None:
+        if element.get('name') == 'Label':
+          string = element.find('String')
+          if string is not None:
+            labels[name] = string.get('value')
+        elif element.get('name') == 'Group':
+          groups[name] = [link.get('value') for link in element.iter('Link')]
+      elif element.tag == 'Object':
+        name = None
+        element.clear()
+
+  refdes = set()
+  for layer in ('Top', 'Bottom'):
+    refdes.update(groups.get('Components%s'%layer, []))
+    for feature in groups.get('PlaceBound%s'%layer, []):
+      label = labels.get(feature, '')
+      refdes.add(label[label.find('_')+1:])
+  return refdes
+
+
+def validate_product(product_path):
+  # consistency of one product folder: components.txt against the model,
+  # the note folders, the test step pages and the picture sidecars.
+  # Returns a report dict, an empty list means no problem of that kind
+  import zipfile
+  import xml.etree.ElementTree as ElementTree
+  report = {'product': os.path.basename(product_path), 'errors': []}
+  prodfile = os.path.join(product_path, 'components.txt')
+  try:
+    model = ProductModel.parse(prodfile)
+  except OSError as e:
+    report['errors'].append('components.txt: %s'%e)
+    return report
+
+  known = {group: {refdes for refdes_list in data.values() for refdes in refdes_list}
+           for group, data in (('components', model.components), ('testpoints', model.testpoints))}
+  all_refdes = known['components'] | known['testpoints']
+
+  # model, from the sidecar when it is up to date
+  model_file = os.path.join(product_path, MODEL_FILE)
+  records = load_model_cache(os.path.join(product_path, MODEL_CACHE_FILE), model_file)
+  if records is not None:
+    model_refdes = set(records)
+  else:
+    try:
+      model_refdes = read_model_refdes(model_file)
+    except (OSError, KeyError, zipfile.BadZipFile, ElementTree.ParseError) as e:
+      report['errors'].append('%s: %s'%(MODEL_FILE, e))
+      model_refdes = None
+  if model_refdes is not None:
+    report['missing_in_model'] = sorted(all_refdes - model_refdes)
+    report['missing_in_components'] = sorted(model_refdes - all_refdes)
+
+  # note folders of refdes that are not (or no longer) in components.txt
+  report['orphaned_notes'] = []
+  report['missing_picture_sidecars'] = []
+  for group, refdes_set in known.items():
+    group_path = os.path.join(product_path, group)
+    try:
+      with os.scandir(group_path) as entries:
+        folders = sorted(entry.name for entry in entries if entry.is_dir())
+    except FileNotFoundError:
+      continue
+    for folder in folders:
+      if folder not in refdes_set:
+        report['orphaned_notes'].append('%s/%s'%(group, folder))
+      for picture in list_pictures(os.path.join(group_path, folder)):
+        if not os.path.isfile(os.path.splitext(picture)[0] + '.txt'):
+          report['missing_picture_sidecars'].append(os.path.relpath(picture, product_path).replace(os.sep, '/'))
+
+  # pages a test step refers to that components.txt does not have
+  report['unknown_pages'] = {}
+  teststeps_path = os.path.join(product_path, 'teststeps')
+  try:
+    test_steps = sorted(x for x in os.listdir(teststeps_path) if os.path.isdir(os.path.join(teststeps_path, x)))
+  except FileNotFoundError:
+    test_steps = []
+  for test_name in test_steps:
+    config = configparser.ConfigParser()
+    try:
+      config.read(os.path.join(teststeps_path, test_name, 'teststep.ini'))
+    except configparser.Error as e:
+      report['errors'].append('%s/teststep.ini: %s'%(test_name, e))
+      continue
+    if config.has_section('pages'):
+      unknown = sorted(key for key in config['pages'] if not scope_pages(model, key))
+      if unknown:
+        report['unknown_pages'][test_name] = unknown
+
+  return report
+
+
+def scope_pages(model, key):
+  # pages a [pages] key of teststep.ini stands for: the page, or the glob's matches
+  if key in model.components:
+    return [key]
+  return fnmatch.filter(model.pages, key.lower())
+
+
+def _scope_patterns(value):
+  # "R1 TP* -R5" -> [(exclude, pattern)]
+  return [(token[0] in '-!', token.lstrip('-!')) for token in re.split(r'[\s,]+', value) if token.lstrip('-!')]
+
+
+def _scope_match(keys, pattern):
+  # refdes in keys (upper -> refdes) matching a name or glob, any case
+  pattern = pattern.upper()
+  if pattern == 'ALL':
+    return set(keys.values())
+  if pattern == 'NONE':
+    return set()
+  if any(c in pattern for c in '*?['):
+    match = re.compile(fnmatch.translate(pattern)).match
+    return {refdes for key, refdes in keys.items() if match(key)}
+  refdes = keys.get(pattern)
+  return {refdes} if refdes else set()
+
+
+def resolve_scope(model, pages, refdes_rules):
+  # page -> selected refdes for a test step, in teststep.ini order.
+  #
+  # pages is the [pages] section: page name or glob -> "all", "none" or
+  # refdes names and globs, "-" or "!" in front excludes; a value with
+  # only exclusions starts from the whole page, an empty value is "none"
+  # as before. refdes_rules is the
+  # [refdes] section: "include" adds refdes from any page, "exclude"
+  # drops them everywhere
+  selected = {}
+  for key, value in pages.items():
+    page_names = scope_pages(model, key)
+    patterns = _scope_patterns(value)
+    for page in page_names:
+      keys = model.page_keys(page)
+      included, excluded = set(), set()
+      for exclude, pattern in patterns:
+        (excluded if exclude else included).update(_scope_match(keys, pattern))
+      if patterns and all(exclude for exclude, pattern in patterns):
+        included = set(keys.values())
+      selected.setdefault(page, set()).update(included - excluded)
+
+  include = _scope_patterns(refdes_rules.get('include', ''))
+  exclude = _scope_patterns(refdes_rules.get('exclude', ''))
+  for page in model.pages:
+    keys = model.page_keys(page)
+    for negated, pattern in include:
+      found = _scope_match(keys, pattern)
+      if found:
+        selected.setdefault(page, set()).update(found)
+    if page in selected:
+      for negated, pattern in exclude:
+        selected[page] -= _scope_match(keys, pattern)
+
+  return {page: refdes for page, refdes in selected.items() if refdes}
+
+
+def scoped_pages(data, scope):
+  # {page: [refdes]} of one group cut down to the scope, lists of whole
+  # pages are shared, not copied
+  scoped = {}
+  for page, refdes in scope.items():
+    values = data.get(page, [])
+    if len(refdes) < len(values) or not refdes.issuperset(values):
+      values = [x for x in values if x in refdes]
+    if values:
+      scoped[page] = values
+  return scoped
+
+
+def report_entries(groups, path, notes):
+  # (group, page, refdes, note folder) of the refdes in scope with notes.
+  # groups: {'Components': {page: [refdes]}, 'Testpoints': {...}}
+  entries = []
+  for group, data in groups.items():
+    with_notes = notes.notes(path[group])
+    for page, refdes_list in data.items():
+      for refdes in sorted(refdes_list):
+        if refdes in with_notes:
+          entries.append((group, page, refdes, os.path.join(path[group], refdes)))
+  return entries
+
+
+REPORT_STYLE = """body { font-family: sans-serif; margin: 2em; }
+pre { white-space: pre-wrap; background: #f4f4f4; padding: .5em; }
+figure { display: inline-block; margin: .5em; vertical-align: top; max-width: 20em; }
+figcaption { font-size: small; white-space: pre-wrap; }"""
+
+
+def _report_picture(picture_path, thumbnail):
+  # runs on a report worker: thumbnail and caption of one picture as html
+  import html
+  import base64
+  data = thumbnail(picture_path)
+  caption = read_text(os.path.splitext(picture_path)[0] + '.txt') or ''
+  name = html.escape(os.path.basename(picture_path))
+  if data:
+    img = '<img src="data:image/jpeg;base64,%s" alt="%s">'%(base64.b64encode(data).decode('ascii'), name)
+  else:
+    img = '<p>%s could not be read</p>'%name
+  return '<figure>%s<figcaption><b>%s</b>\n%s</figcaption></figure>\n'%(img, name, html.escape(caption))
+
+
+def write_report(report_path, title, readme, entries, thumbnail, workers, progress, is_cancelled):
+  # html report of a test step, written while it is produced. thumbnail
+  # (picture path -> jpeg bytes or None) runs on a pool of workers; at most
+  # 2*workers pictures are in flight, so memory stays bounded however many
+  # pictures there are. progress(n) gets the number of entries written.
+  # Returns the number of pictures, or None when cancelled
+  import html
+  tmp_path = report_path + '.tmp'
+  pending = deque() # html strings and futures, in output order
+  in_flight = 0
+  pictures = 0
+  cancelled = False
+
+  try:
+    with open(tmp_path, 'w', encoding='utf-8') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+      def write_front():
+        item = pending.popleft()
+        if isinstance(item, str):
+          f.write(item)
+          return 0
+        f.write(item.result())
+        return 1
+
+      try:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s</title><style>%s</style></head><body>\n'
+                %(html.escape(title), REPORT_STYLE))
+        f.write('<h1>%s</h1>\n<pre>%s</pre>\n'%(html.escape(title), html.escape(readme or '')))
+
+        page = None
+        for i, (group, entry_page, refdes, folder) in enumerate(entries):
+          if is_cancelled():
+            cancelled = True
+            break
+          if (group, entry_page) != page:
+            page = (group, entry_page)
+            pending.append('<h2>%s: %s</h2>\n'%(html.escape(group), html.escape(entry_page)))
+          pending.append('<h3>%s</h3>\n<pre>%s</pre>\n'
+                         %(html.escape(refdes), html.escape(read_text(os.path.join(folder, 'readme.txt')) or '')))
+
+          for picture_path in list_pictures(folder):
+            pending.append(executor.submit(_report_picture, picture_path, thumbnail))
+            in_flight += 1
+            pictures += 1
+            while in_flight > 2*workers:
+              in_flight -= write_front()
+
+          # entries before the pictures still in flight are complete
+          while pending and (isinstance(pending[0], str) or pending[0].done()):
+            in_flight -= write_front()
+          progress(i + 1)
+
+        while pending and not cancelled:
+          write_front()
+        f.write('</body></html>\n')
+      finally:
+        for item in pending:
+          if not isinstance(item, str):
+            item.cancel()
+  except BaseException:
+    cancelled = True
+    raise
+  finally:
+    if cancelled and os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+  if cancelled:
+    return None
+  os.replace(tmp_path, report_path)
+  return pictures
+
+
+class ProductCatalogue:
+  # products, test steps and counts of every products_path, kept in a local
+  # SQLite file. A product is only read again when the mtime of its folder,
+  # components.txt, teststeps/, components/ or testpoints/ changed, and the
+  # products_path itself only listed again when its own mtime changed
+  def __init__(self, db_path):
+    self.db_path = db_path
+
+  def _connect(self):
+    import sqlite3
+    os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+    db = sqlite3.connect(self.db_path, timeout=10)
+    db.execute('CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY, mtime INTEGER, folders TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS products (root TEXT, name TEXT, stamp TEXT, tests TEXT, '
+               'pages INTEGER, components INTEGER, testpoints INTEGER, notes INTEGER, PRIMARY KEY (root, name))')
+    return db
+
+  def _rows(self, db, products_path):
+    rows = db.execute('SELECT name, tests, pages, components, testpoints, notes FROM products '
+                      'WHERE root = ? AND tests IS NOT NULL ORDER BY name', (products_path,))
+    return [{'name': name, 'tests': json.loads(tests), 'pages': pages, 'components': components,
+             'testpoints': testpoints, 'notes': notes}
+            for name, tests, pages, components, testpoints, notes in rows]
+
+  def products(self, products_path):
+    # what is known without touching the share: [{'name', 'tests', 'pages',
+    # 'components', 'testpoints', 'notes'}] sorted by name
+    import sqlite3
+    try:
+      db = self._connect()
+    except (OSError, sqlite3.Error):
+      return []
+    try:
+      return self._rows(db, products_path)
+    finally:
+      db.close()
+
+  def _stamp(self, product_path):
+    stamp = []
+    for name in ('', 'components.txt', 'teststeps', 'components', 'testpoints'):
+      try:
+        st = os.stat(os.path.join(product_path, name))
+        stamp.append([st.st_mtime_ns, st.st_size if name else 0])
+      except OSError:
+        stamp.append(None)
+    return json.dumps(stamp)
+
+  def _scan(self, product_path):
+    # (tests, pages, components, testpoints, notes), None when not a product
+    prodfile = os.path.join(product_path, 'components.txt')
+    if not os.path.isfile(prodfile):
+      return None
+    model = ProductModel.parse(prodfile)
+
+    def folders(path):
+      try:
+        with os.scandir(path) as entries:
+          return sorted(entry.name for entry in entries if entry.is_dir())
+      except OSError:
+        return []
+
+    notes = len(folders(os.path.join(product_path, 'components'))) + len(folders(os.path.join(product_path, 'testpoints')))
+    return (folders(os.path.join(product_path, 'teststeps')), len(model.pages),
+            sum(map(len, model.components.values())), sum(map(len, model.testpoints.values())), notes)
+
+  def refresh(self, products_path, is_cancelled):
+    # bring the catalogue of products_path up to date and return products(),
+    # None when cancelled
+    mtime = os.stat(products_path).st_mtime_ns
+    db = self._connect()
+    try:
+      row = db.execute('SELECT mtime, folders FROM roots WHERE path = ?', (products_path,)).fetchone()
+      if row and row[0] == mtime:
+        folders = json.loads(row[1])
+      else:
+        with os.scandir(products_path) as entries:
+          folders = sorted(entry.name for entry in entries if entry.is_dir())
+        db.execute('INSERT OR REPLACE INTO roots (path, mtime, folders) VALUES (?, ?, ?)',
+                   (products_path, mtime, json.dumps(folders)))
+
+      stamps = dict(db.execute('SELECT name, stamp FROM products WHERE root = ?', (products_path,)))
+      for name in set(stamps) - set(folders):
+        db.execute('DELETE FROM products WHERE root = ? AND name = ?', (products_path, name))
+
+      for name in folders:
+        if is_cancelled():
+          db.commit() # keep what was read so far
+          return None
+        product_path = os.path.join(products_path, name)
+        stamp = self._stamp(product_path)
+        if stamps.get(name) == stamp:
+          continue
+        try:
+          scanned = self._scan(product_path)
+        except OSError:
+          continue
+        # folders without components.txt are kept too, with tests NULL,
+        # so they are not read again until they change
+        tests, pages, components, testpoints, notes = scanned or (None, 0, 0, 0, 0)
+        db.execute('INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   (products_path, name, stamp, None if tests is None else json.dumps(tests),
+                    pages, components, testpoints, notes))
+      db.commit()
+      return self._rows(db, products_path)
+    finally:
+      db.close()
+
+
+def read_product(product_path, notes, is_cancelled):
+  # everything _apply_product needs, read off the GUI thread
+  prodfile = os.path.join(product_path, "components.txt")
+  if not os.path.isfile(prodfile):
+    return None
+
+  model = load_product_model(prodfile)
+
+  if is_cancelled():
+    return None
+
+  path = {
+    "Testpoints": os.path.join(product_path, "testpoints"),
+    "Components": os.path.join(product_path, "components"),
+  }
+  notes.refresh(path["Testpoints"])
+  notes.refresh(path["Components"])
+
+  teststeps_path = os.path.join(product_path, "teststeps")
+  test_steps = [x for x in os.listdir(teststeps_path) if os.path.isdir(os.path.join(teststeps_path,x))]
+
+  model_file = os.path.join(product_path, MODEL_FILE)
+  cache_file = os.path.join(product_path, MODEL_CACHE_FILE)
+
+  return {
+    'model': model,
+    'path': path,
+    'teststeps_path': teststeps_path,
+    'test_steps': test_steps,
+    'model_file': model_file,
+    'model_cache_file': cache_file,
+    'model_cache': load_model_cache(cache_file, model_file),
+  }
+
+
+def read_test(test_folder, model, is_cancelled):
+  # the test step with its scope resolved against the product model
+  config = configparser.ConfigParser()
+  config.read(os.path.join(test_folder, 'teststep.ini'))
+  pages = dict(config['pages']) if config.has_section('pages') else {}
+  refdes_rules = dict(config['refdes']) if config.has_section('refdes') else {}
+
+  scope = resolve_scope(model, pages, refdes_rules)
+
+  if is_cancelled():
+    return None
+
+  readme, readme_version = read_versioned(os.path.join(test_folder, 'readme.txt'))
+  return {
+    'folder': test_folder,
+    'pages': pages,
+    'components': scoped_pages(model.components, scope),
+    'testpoints': scoped_pages(model.testpoints, scope),
+    'readme': readme,
+    'readme_version': readme_version,
+  }
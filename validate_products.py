@@ -0,0 +1,76 @@
+# Consistency check of all products, outside FreeCAD.
+#
+# Every product folder under products_path is checked in its own process:
+# refdes missing from the model or from components.txt, orphaned note
+# folders, unknown test step pages and pictures without a .txt sidecar.
+#
+#   python validate_products.py /share/products --json report.json
+#
+# Exits with 1 when any product has a problem, so it can gate nightly jobs.
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import navigator_core as core
+
+# report entries that list problems
+CHECKS = ('missing_in_model', 'missing_in_components', 'orphaned_notes',
+          'missing_picture_sidecars', 'unknown_pages', 'errors')
+
+
+def check(product_path):
+  # runs in a worker process, one product at a time
+  try:
+    return core.validate_product(product_path)
+  except Exception as e:
+    return {'product': os.path.basename(product_path), 'errors': ['%s: %s'%(type(e).__name__, e)]}
+
+
+def problems(report):
+  return sum(len(report.get(name, ())) for name in CHECKS)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Check that the products agree with their models, notes and test steps')
+  parser.add_argument('products_path', help='folder holding one folder per product')
+  parser.add_argument('--jobs', type=int, default=None, help='worker processes, default one per CPU')
+  parser.add_argument('--json', help='write the report to this file, - for stdout')
+  args = parser.parse_args(argv)
+
+  products = sorted(entry.path for entry in os.scandir(args.products_path)
+                    if entry.is_dir() and os.path.isfile(os.path.join(entry.path, 'components.txt')))
+
+  start = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+    reports = list(executor.map(check, products, chunksize=4))
+  elapsed = time.perf_counter() - start
+
+  failed = [report for report in reports if problems(report)]
+  for report in failed:
+    print('%s:'%report['product'], file=sys.stderr)
+    for name in CHECKS:
+      if report.get(name):
+        print('  %-24s %s'%(name, report[name]), file=sys.stderr)
+  print('%d products checked in %.1f s, %d with problems'%(len(reports), elapsed, len(failed)), file=sys.stderr)
+
+  if args.json:
+    data = {
+      'products_path': os.path.abspath(args.products_path),
+      'checked': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'products': reports,
+    }
+    if args.json == '-':
+      json.dump(data, sys.stdout, indent=1)
+    else:
+      with open(args.json, 'w') as f:
+        json.dump(data, f, indent=1)
+
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())